@@ -11,10 +11,20 @@ import minion.backend.views.invites
 import minion.backend.views.reports
 import minion.backend.views.users
 import minion.backend.views.scans
+import minion.backend.views.campaigns
 import minion.backend.views.sites
 import minion.backend.views.plans
 import minion.backend.views.plugins
 import minion.backend.views.issues
+import minion.backend.views.metrics
+
+from minion.backend.compression import init_compression
+from minion.backend.metrics import init_metrics
+from minion.backend.profiler import init_profiler
+from minion.backend.utils import backend_config
+init_compression(app, backend_config())
+init_metrics(app)
+init_profiler(app, backend_config())
 
 def configure_app(app, production=True, debug=False):
     app.debug = debug
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+#
+# Time budgets for scans and plugin sessions, in seconds.
+#
+# A plan can have a budget for the whole scan and each step in its workflow
+# can have a budget for its session:
+#
+#   { "name": "basic",
+#     "budget": 3600,
+#     "workflow": [ { "plugin_name": "...", "budget": 600, ... } ] }
+#
+# POST /scans can override the scan budget with a "budget" of its own. The
+# budgets of a scan are stored in meta.budget when it is created:
+#
+#   "budget": { "scan": 3600, "sessions": { "<session id>": 600 } }
+#
+# Scans and sessions without a budget use the defaults from the 'budget'
+# section of backend.json, which are unlimited unless configured:
+#
+#   "budget": { "scan": 14400, "session": 3600 }
+#
+# The scan worker stops a session that runs out of its budget, marks it
+# TIMEOUT and moves on to the next session. When the scan runs out of its
+# budget the remaining sessions are cancelled and the scan finishes as
+# TIMEOUT.
+#
+
+DEFAULT_BUDGET_CONFIG = {
+    'scan': None,
+    'session': None
+}
+
+def budget_config(cfg):
+    config = dict(DEFAULT_BUDGET_CONFIG)
+    config.update(cfg.get('budget', {}))
+    return config
+
+def valid_budget(budget):
+    return budget is None or (isinstance(budget, (int, long, float)) and not isinstance(budget, bool) and budget > 0)
+
+def scan_budget(plan, sessions, requested=None):
+    """ Return the budgets of a new scan. sessions are the sessions that
+    were created for the steps of the plan, in the same order. """
+    return {'scan': requested if requested is not None else plan.get('budget'),
+            'sessions': dict((session['id'], step.get('budget'))
+                             for step, session in zip(plan['workflow'], sessions)
+                             if step.get('budget') is not None)}
+
+class Deadline:
+
+    def __init__(self, budget, config, started=None):
+        budget = budget or {}
+        self.started = started if started is not None else time.time()
+        self.scan_budget = budget.get('scan') or config['scan']
+        self.session_budgets = budget.get('sessions', {})
+        self.default_session_budget = config['session']
+
+    @property
+    def deadline(self):
+        if self.scan_budget is not None:
+            return self.started + self.scan_budget
+
+    def expired(self, now=None):
+        now = now if now is not None else time.time()
+        return self.deadline is not None and now >= self.deadline
+
+    def session_timeout(self, session_id, now=None):
+        """ Return how long a session that starts now may run, or None if
+        it may run forever. """
+        now = now if now is not None else time.time()
+        timeouts = []
+        budget = self.session_budgets.get(session_id, self.default_session_budget)
+        if budget is not None:
+            timeouts.append(budget)
+        if self.deadline is not None:
+            timeouts.append(max(self.deadline - now, 0))
+        return min(timeouts) if timeouts else None
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import urlparse
+
+from pymongo.errors import DuplicateKeyError
+
+#
+# Callback delivery. Callbacks are posted from a dedicated callback worker
+# with a pooled HTTP session, a timeout and retries with exponential backoff.
+# It is configured in the 'callback' section of backend.json:
+#
+#   "callback": { "timeout": 10,
+#                 "max_retries": 5,
+#                 "backoff": 2,
+#                 "max_backoff": 300,
+#                 "max_concurrency": 4,
+#                 "slot_ttl": 60,
+#                 "pool_size": 10 }
+#
+# At most max_concurrency deliveries go to a single endpoint at once, across
+# all callback workers. Each delivery holds one of the numbered slots of its
+# endpoint in the callback_slots collection, which has a unique index on
+# endpoint and slot. A slot expires slot_ttl seconds after it was taken, so
+# the slots of a worker that died mid delivery free up by themselves.
+# slot_ttl must be well above timeout.
+#
+# A delivery that finds its endpoint busy is tried again later like a
+# failed one and counts against max_retries as well.
+#
+
+DEFAULT_CALLBACK_CONFIG = {
+    'timeout': 10,
+    'max_retries': 5,
+    'backoff': 2,
+    'max_backoff': 300,
+    'max_concurrency': 4,
+    'slot_ttl': 60,
+    'pool_size': 10
+}
+
+def callback_config(cfg):
+    config = dict(DEFAULT_CALLBACK_CONFIG)
+    config.update(cfg.get('callback', {}))
+    return config
+
+def callback_backoff(retries, config):
+    return min(config['backoff'] ** (retries + 1), config['max_backoff'])
+
+def retry_countdown(attempt, config):
+    """ Return how long to wait before trying a delivery again after its
+    attempt-th try (counting from 0) went wrong, or None to give up. """
+    if attempt < config['max_retries']:
+        return callback_backoff(attempt, config)
+
+def callback_endpoint(url):
+    u = urlparse.urlparse(url)
+    return "%s://%s" % (u.scheme, u.netloc)
+
+def ensure_indexes(slots):
+    slots.ensure_index([('endpoint', 1), ('slot', 1)], unique=True)
+
+def acquire_slot(slots, endpoint, holder, limit, ttl, now=None):
+    """ Take a free or expired slot of the endpoint for holder. Returns the
+    slot number or None if all limit slots are taken. """
+    now = now if now is not None else datetime.datetime.utcnow()
+    for slot in range(limit):
+        try:
+            slots.find_and_modify({'endpoint': endpoint, 'slot': slot, 'expires': {'$lt': now}},
+                                  {'$set': {'holder': holder,
+                                            'expires': now + datetime.timedelta(seconds=ttl)}},
+                                  upsert=True)
+            return slot
+        except DuplicateKeyError:
+            # Held and not expired
+            pass
+
+def release_slot(slots, endpoint, slot, holder):
+    slots.remove({'endpoint': endpoint, 'slot': slot, 'holder': holder})
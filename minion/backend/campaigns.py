@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+
+#
+# A campaign runs one plan against every site in a group. All its scans are
+# created up front in the CREATED state, tagged with meta.campaign, and are
+# released to the scheduler max_concurrency at a time. The campaign
+# document keeps the progress and the aggregated results:
+#
+#   { "id": "...",
+#     "group": "security",
+#     "plan": "basic",
+#     "state": "RUNNING",          # then FINISHED
+#     "total": 120,                # scans in the campaign
+#     "waiting": 100,              # scans not released yet
+#     "slots": 0,                  # scans that can still be released now
+#     "done": 15,                  # scans that ended
+#     "progress": { "FINISHED": 14, "FAILED": 1 },
+#     "issues": { "high": 2, "medium": 7, "low": 20, "info": 31 } }
+#
+# Slots are taken and given back with atomic updates of the campaign
+# document, so concurrent releases never exceed max_concurrency. Released
+# scans are marked with meta.released, only those give a slot back when
+# they end.
+#
+
+DEFAULT_MAX_CONCURRENCY = 5
+
+SEVERITIES = ('High', 'Medium', 'Low', 'Info')
+
+def new_campaign(campaign_id, group, plan, user, scan_ids, max_concurrency):
+    now = datetime.datetime.utcnow()
+    return { 'id': campaign_id,
+             'group': group,
+             'plan': plan,
+             'user': user,
+             'state': 'RUNNING' if scan_ids else 'FINISHED',
+             'created': now,
+             'finished': None if scan_ids else now,
+             'max_concurrency': max_concurrency,
+             'total': len(scan_ids),
+             'waiting': len(scan_ids),
+             'slots': max_concurrency,
+             'done': 0,
+             'progress': {},
+             'issues': dict((severity.lower(), 0) for severity in SEVERITIES),
+             'scans': scan_ids }
+
+def release(campaigns, scans, campaign_id):
+    """ Queue waiting scans of the campaign while it has free slots.
+    Returns the ids of the released scans. """
+    released = []
+    while True:
+        campaign = campaigns.find_and_modify({'id': campaign_id, 'state': 'RUNNING',
+                                              'slots': {'$gt': 0}, 'waiting': {'$gt': 0}},
+                                             {'$inc': {'slots': -1, 'waiting': -1}})
+        if campaign is None:
+            break
+        scan = scans.find_and_modify({'meta.campaign': campaign_id, 'state': 'CREATED'},
+                                     {'$set': {'state': 'QUEUED',
+                                               'queued': datetime.datetime.utcnow(),
+                                               'meta.dispatched': None,
+                                               'meta.released': True}},
+                                     sort=[('created', 1)])
+        if scan is None:
+            # The remaining scans were stopped before they were released
+            campaigns.update({'id': campaign_id}, {'$inc': {'slots': 1, 'waiting': 1}})
+            break
+        released.append(scan['id'])
+    return released
+
+def count_issues(scan):
+    counts = dict((severity.lower(), 0) for severity in SEVERITIES)
+    for session in scan['sessions']:
+        for issue in session['issues']:
+            if issue.get('Severity') in SEVERITIES:
+                counts[issue['Severity'].lower()] += 1
+    return counts
+
+def scan_ended(campaigns, scans, scan, state):
+    """ Add the outcome of a campaign scan to its campaign and release the
+    next scans. Returns the ids of the released scans. """
+    campaign_id = scan.get('meta', {}).get('campaign')
+    if not campaign_id:
+        return []
+    # A stopped scan can be finished as well, count it only once
+    if scans.find_and_modify({'id': scan['id'], 'meta.campaign_done': {'$exists': False}},
+                             {'$set': {'meta.campaign_done': True}}) is None:
+        return []
+    inc = {'done': 1, 'progress.' + state: 1}
+    for severity, count in count_issues(scan).items():
+        inc['issues.' + severity] = count
+    # Stopping a scan sets queued as well, only released scans took a slot
+    if scan['meta'].get('released'):
+        inc['slots'] = 1
+    else:
+        inc['waiting'] = -1
+    campaign = campaigns.find_and_modify({'id': campaign_id}, {'$inc': inc}, new=True)
+    if campaign is None:
+        return []
+    if campaign['done'] >= campaign['total']:
+        campaigns.update({'id': campaign_id, 'state': 'RUNNING'},
+                         {'$set': {'state': 'FINISHED', 'finished': datetime.datetime.utcnow()}})
+        return []
+    return release(campaigns, scans, campaign_id)
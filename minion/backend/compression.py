@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import zlib
+from cStringIO import StringIO
+
+from flask import request
+
+DEFAULT_COMPRESSION_CONFIG = {
+    'enabled': True,
+    'level': 6,
+    'min_size': 1024,
+    'mimetypes': ['application/json', 'text/html', 'text/plain']
+}
+
+def compression_config(cfg):
+    config = dict(DEFAULT_COMPRESSION_CONFIG)
+    config.update(cfg.get('api', {}).get('compression', {}))
+    return config
+
+def gzip_compress(data, level):
+    buffer = StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+def deflate_compress(data, level):
+    return zlib.compress(data, level)
+
+ENCODERS = (('gzip', gzip_compress), ('deflate', deflate_compress))
+
+def negotiate_encoding(accept_encodings):
+    """ Pick the encoding the client prefers from the ones we support.
+    Returns None if the client accepts neither. """
+    best, best_quality = None, 0
+    for name, encoder in ENCODERS:
+        quality = accept_encodings[name]
+        if quality > best_quality:
+            best, best_quality = (name, encoder), quality
+    return best
+
+def compress_response(response, config):
+    """ Compress the response body with gzip or deflate if the client
+    accepts it and the body is large enough to be worth it. Responses
+    that are streamed, already encoded or not of a compressible type
+    are returned untouched. """
+
+    if not config['enabled']:
+        return response
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code < 200 or response.status_code >= 300:
+        return response
+    if response.mimetype not in config['mimetypes']:
+        return response
+
+    # Merged into a Vary the view may have set already
+    response.vary.add('Accept-Encoding')
+
+    data = response.data
+    if len(data) < config['min_size']:
+        return response
+
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    name, encoder = encoding
+    response.data = encoder(data, config['level'])
+    response.headers['Content-Encoding'] = name
+    response.headers['Content-Length'] = len(response.data)
+    return response
+
+def init_compression(app, cfg):
+    config = compression_config(cfg)
+    @app.after_request
+    def compress(response):
+        return compress_response(response, config)
@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend.scheduler import ACTIVE_STATES
+
+#
+# At most one scan runs a plan against a target at any time. A scan holds a
+# lease on its (target, plan) pair from the moment it is started or
+# dispatched until it ends. Leases live in the scan_leases collection with
+# a unique index on target and plan, so taking one is atomic across all API
+# processes and workers.
+#
+# What happens to a second scan for the same pair is decided by the
+# scheduler.duplicates setting in backend.json:
+#
+#   "queue"  - the scan waits as pending until the lease is free (default)
+#   "attach" - the scan is not started, the caller gets the running scan
+#   "reject" - the scan is not started and the caller gets an error
+#   "allow"  - no leases, duplicates run side by side
+#
+# A lease whose scan is no longer active, because a worker died before it
+# could release it, is taken over by the next scan.
+#
+
+POLICIES = ('queue', 'attach', 'reject', 'allow')
+
+def ensure_indexes(leases):
+    leases.ensure_index([('target', 1), ('plan', 1)], unique=True)
+
+def acquire(leases, scans, scan):
+    """ Try to take the lease for the scan. Returns the id of the scan that
+    holds the lease afterwards, which is the scan itself on success. """
+    key = {'target': scan['configuration']['target'], 'plan': scan['plan']['name']}
+    try:
+        leases.insert(dict(key, scan_id=scan['id'], acquired=datetime.datetime.utcnow()))
+        return scan['id']
+    except DuplicateKeyError:
+        pass
+    lease = leases.find_one(key)
+    if lease is None:
+        # Released in the meantime, try again next time
+        return None
+    if lease['scan_id'] == scan['id']:
+        return scan['id']
+    if scans.find_one({'id': lease['scan_id'], 'state': {'$in': ACTIVE_STATES}}, {'id': 1}):
+        return lease['scan_id']
+    # The holder is gone, take the lease over unless somebody else did
+    taken = leases.find_and_modify(dict(key, scan_id=lease['scan_id']),
+                                   {'$set': {'scan_id': scan['id'], 'acquired': datetime.datetime.utcnow()}})
+    if taken is None:
+        lease = leases.find_one(key)
+        return lease['scan_id'] if lease else None
+    return scan['id']
+
+def release(leases, scan_id):
+    leases.remove({'scan_id': scan_id})
@@ -0,0 +1,153 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+#
+# A small in-process metrics registry that renders the Prometheus text
+# exposition format. Every API worker process keeps its own registry, so
+# when running under gunicorn each scrape sees the numbers of the worker
+# that happened to serve it.
+#
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, type, help):
+        self._descriptions[name] = (type, help)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets,
+                                                     'counts': [0] * len(buckets),
+                                                     'sum': 0.0,
+                                                     'count': 0}
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def counter(self, name, labels=None):
+        return self._counters.get((name, tuple(sorted((labels or {}).items()))), 0)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, dict(v, counts=list(v['counts']))) for k, v in self._histograms.items())
+        described = set()
+        def header(name):
+            if name not in described and name in self._descriptions:
+                type, help = self._descriptions[name]
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+            described.add(name)
+        for (name, labels), value in counters:
+            header(name)
+            lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        for (name, labels), histogram in histograms:
+            header(name)
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append("%s_bucket%s %s" % (name, _format_labels(labels + (('le', _format_value(bound)),)),
+                                                 _format_value(count)))
+            lines.append("%s_bucket%s %s" % (name, _format_labels(labels + (('le', '+Inf'),)),
+                                             _format_value(histogram['count'])))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(histogram['sum'])))
+            lines.append("%s_count%s %s" % (name, _format_labels(labels), _format_value(histogram['count'])))
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+registry.describe("minion_http_requests_total", "counter",
+                  "Number of API requests by route, method and status code.")
+registry.describe("minion_http_request_duration_seconds", "histogram",
+                  "API request latency by route and method.")
+registry.describe("minion_http_mongo_queries_total", "counter",
+                  "Number of mongodb operations done while serving a route.")
+registry.describe("minion_http_mongo_seconds_total", "counter",
+                  "Time spent in mongodb operations while serving a route.")
+registry.describe("minion_mongo_operations_total", "counter",
+                  "Number of mongodb operations by collection and operation.")
+registry.describe("minion_mongo_operation_seconds_total", "counter",
+                  "Time spent in mongodb operations by collection and operation.")
+
+def record_mongo_operation(collection, operation, duration, queries=1):
+    """ Called by the instrumented mongodb collections for every operation. """
+    labels = {'collection': collection, 'operation': operation}
+    registry.inc("minion_mongo_operations_total", labels, queries)
+    registry.inc("minion_mongo_operation_seconds_total", labels, duration)
+    if has_request_context() and hasattr(g, 'metrics_start'):
+        g.mongo_queries += queries
+        g.mongo_seconds += duration
+
+def _route():
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return "unmatched"
+
+def _record_request(status_code):
+    if getattr(g, 'metrics_recorded', True):
+        return
+    g.metrics_recorded = True
+    route, method = _route(), request.method
+    registry.inc("minion_http_requests_total", {'route': route, 'method': method, 'status': status_code})
+    registry.observe("minion_http_request_duration_seconds", time.time() - g.metrics_start,
+                     {'route': route, 'method': method})
+    registry.inc("minion_http_mongo_queries_total", {'route': route}, g.mongo_queries)
+    registry.inc("minion_http_mongo_seconds_total", {'route': route}, g.mongo_seconds)
+
+def init_metrics(app):
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.time()
+        g.metrics_recorded = False
+        g.mongo_queries = 0
+        g.mongo_seconds = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        _record_request(response.status_code)
+        return response
+
+    # Unhandled exceptions skip the after_request handlers. Flask turns
+    # those into a 500 so that is what we record.
+
+    @app.teardown_request
+    def record_failed_request_metrics(exception=None):
+        if exception is not None:
+            _record_request(500)
@@ -0,0 +1,276 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import Queue
+import logging
+import threading
+import time
+
+from minion.backend import metrics
+from minion.backend.utils import backend_config
+
+#
+# Thin wrappers around pymongo collections and cursors that time every
+# operation and report it to the metrics registry. Everything that is not
+# an operation is passed straight through to the wrapped object.
+#
+# Operations that take longer than mongodb.slow_operation_threshold seconds
+# (default 0.1) are logged together with the shape of their filter and a
+# summary of the query plan, which tells whether an index was used or the
+# whole collection was scanned. To keep the explain() calls themselves
+# cheap a filter shape is explained at most once every
+# mongodb.explain_interval seconds (default 300). The explain() calls run
+# in a background thread, so a slow operation is logged once its plan is
+# known and the request that did it does not wait for that. When too many
+# explains are waiting, slow operations are logged without a plan.
+#
+# A find is timed from its first batch until the cursor is exhausted,
+# closed or garbage collected, so cursors that are only partly read are
+# checked as well.
+#
+
+logger = logging.getLogger(__name__)
+
+cfg = backend_config()
+SLOW_OPERATION_THRESHOLD = cfg.get('mongodb', {}).get('slow_operation_threshold', 0.1)
+EXPLAIN_INTERVAL = cfg.get('mongodb', {}).get('explain_interval', 300)
+
+metrics.registry.describe("minion_mongo_slow_operations_total", "counter",
+                          "Number of mongodb operations slower than the slow operation threshold.")
+
+def filter_shape(spec):
+    """ Replace the values in a query filter by placeholders so that
+    queries that only differ in their values look the same. """
+    if isinstance(spec, dict):
+        return dict((key, filter_shape(value)) for key, value in spec.items())
+    if isinstance(spec, (list, tuple)):
+        return [filter_shape(spec[0])] if spec else []
+    return '?'
+
+def _winning_stage(plan):
+    """ Walk down a mongodb >= 3.0 query plan to the stage that reads the data. """
+    while plan.get('inputStage'):
+        plan = plan['inputStage']
+    return plan
+
+def summarize_explain(explain):
+    """ Reduce the output of explain() to the access plan, the index that
+    was used and how many documents were examined and returned. Handles
+    both the mongodb 2.x and the >= 3.0 explain formats. """
+    if 'queryPlanner' in explain:
+        stage = _winning_stage(explain['queryPlanner'].get('winningPlan', {}))
+        stats = explain.get('executionStats', {})
+        return {'plan': stage.get('stage'),
+                'index': stage.get('indexName'),
+                'examined': stats.get('totalDocsExamined'),
+                'returned': stats.get('nReturned')}
+    cursor = explain.get('cursor', '')
+    if cursor.startswith('BtreeCursor'):
+        plan, index = 'IXSCAN', cursor[len('BtreeCursor '):]
+    else:
+        plan, index = 'COLLSCAN', None
+    return {'plan': plan,
+            'index': index,
+            'examined': explain.get('nscannedObjects', explain.get('nscanned')),
+            'returned': explain.get('n')}
+
+class SlowOperationLog:
+
+    def __init__(self, threshold, explain_interval, max_pending=100):
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self._lock = threading.Lock()
+        self._explained = {}
+        self._pending = Queue.Queue(max_pending)
+        self._thread = None
+
+    def _should_explain(self, key):
+        now = time.time()
+        with self._lock:
+            last = self._explained.get(key)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self._explained[key] = now
+            return True
+
+    def check(self, collection, operation, spec, duration):
+        if self.threshold is None or duration < self.threshold:
+            return
+        if not isinstance(spec, dict):
+            spec = {}
+        shape = filter_shape(spec)
+        if self._should_explain((collection.name, operation, repr(sorted(shape.items())))):
+            try:
+                self._pending.put_nowait((collection, operation, spec, shape, duration))
+                self._start()
+                return
+            except Queue.Full:
+                pass
+        self._report(collection, operation, shape, duration, None)
+
+    def wait(self):
+        """ Block until the pending explains are done. """
+        self._pending.join()
+
+    def _start(self):
+        # Also after a fork, which leaves the thread of the parent behind
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            collection, operation, spec, shape, duration = self._pending.get()
+            try:
+                summary = None
+                try:
+                    summary = summarize_explain(collection.find(spec).explain())
+                except Exception as e:
+                    logger.debug("Could not explain %s.%s: %s" % (collection.name, operation, str(e)))
+                self._report(collection, operation, shape, duration, summary)
+            except Exception:
+                logger.exception("Error while reporting a slow mongodb operation")
+            finally:
+                self._pending.task_done()
+
+    def _report(self, collection, operation, shape, duration, summary):
+        metrics.registry.inc("minion_mongo_slow_operations_total",
+                             {'collection': collection.name, 'operation': operation,
+                              'plan': summary['plan'] if summary else 'unknown'})
+        logger.warning("Slow mongodb operation %s.%s took %.3fs filter=%s plan=%s" %
+                       (collection.name, operation, duration, shape, summary))
+
+slow_operations = SlowOperationLog(SLOW_OPERATION_THRESHOLD, EXPLAIN_INTERVAL)
+
+class InstrumentedCursor:
+
+    """
+    Wraps a pymongo Cursor. The query only runs when the cursor is iterated
+    or counted, so that is where the time is measured. Chained calls like
+    sort() and limit() return the wrapper so that it stays in place. The
+    time spent iterating is checked for slowness when the cursor is
+    exhausted, closed or garbage collected, whichever comes first.
+    """
+
+    def __init__(self, cursor, collection, spec):
+        self._cursor = cursor
+        self._collection = collection
+        self._spec = spec
+        self._started = False
+        self._checked = False
+        self._elapsed = 0.0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+        def chain(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if result is self._cursor:
+                return self
+            return result
+        return chain
+
+    def __iter__(self):
+        return self
+
+    def __getitem__(self, index):
+        result = self._cursor[index]
+        if result is self._cursor:
+            return self
+        return result
+
+    def next(self):
+        # Only the first batch counts as a query. Fetching more batches
+        # adds to the time spent but not to the number of queries.
+        queries = 0 if self._started else 1
+        self._started = True
+        start = time.time()
+        exhausted = False
+        try:
+            return self._cursor.next()
+        except StopIteration:
+            exhausted = True
+            raise
+        finally:
+            duration = time.time() - start
+            self._elapsed += duration
+            metrics.record_mongo_operation(self._collection.name, 'find', duration, queries)
+            if exhausted:
+                self._check()
+
+    def close(self):
+        try:
+            return self._cursor.close()
+        finally:
+            self._check()
+
+    def __del__(self):
+        try:
+            self._check()
+        except Exception:
+            pass
+
+    def _check(self):
+        if self._started and not self._checked:
+            self._checked = True
+            slow_operations.check(self._collection, 'find', self._spec, self._elapsed)
+
+    def count(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._cursor.count(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            metrics.record_mongo_operation(self._collection.name, 'count', duration)
+            slow_operations.check(self._collection, 'count', self._spec, duration)
+
+def _spec_argument(name, args, kwargs):
+    """ Return the query filter passed to a collection operation. """
+    if name in ('insert', 'save', 'aggregate'):
+        return None
+    if name == 'find_and_modify':
+        return kwargs.get('query', args[0] if args else None)
+    return kwargs.get('spec', kwargs.get('spec_or_id', args[0] if args else None))
+
+class InstrumentedCollection:
+
+    """
+    Wraps a pymongo Collection. Use it like the collection itself:
+
+      scans = InstrumentedCollection(mongo_client.minion.scans)
+      scans.find_one({'id': scan_id})
+    """
+
+    OPERATIONS = ('aggregate', 'count', 'find_and_modify', 'find_one', 'insert',
+                  'remove', 'save', 'update')
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    @property
+    def collection(self):
+        return self._collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self.OPERATIONS:
+            return attribute
+        def operation(*args, **kwargs):
+            start = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                metrics.record_mongo_operation(self._collection.name, name, duration)
+                spec = _spec_argument(name, args, kwargs)
+                if isinstance(spec, dict):
+                    slow_operations.check(self._collection, name, spec, duration)
+        return operation
+
+    def find(self, *args, **kwargs):
+        spec = kwargs.get('spec', args[0] if args else None)
+        return InstrumentedCursor(self._collection.find(*args, **kwargs), self._collection, spec)
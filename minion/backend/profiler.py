@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+#
+# An opt-in sampling profiler. A background thread wakes up every interval
+# seconds, takes the stack of every thread that is currently inside a
+# request or task, and counts identical stacks. The counts are written in
+# the folded format that flamegraph.pl and speedscope read:
+#
+#   <route or task>;module:function;module:function 42
+#
+# One file is written per route or task name, every flush_interval seconds,
+# to <directory>/<name>.<pid>.folded.
+#
+# The profiler is enabled with the 'profiler' section of backend.json:
+#
+#   "profiler": { "enabled": true,
+#                 "interval": 0.01,
+#                 "flush_interval": 60,
+#                 "directory": "/tmp/minion-profiles" }
+#
+# or toggled at runtime by sending the process a SIGUSR2.
+#
+
+DEFAULT_PROFILER_CONFIG = {
+    'enabled': False,
+    'interval': 0.01,
+    'flush_interval': 60,
+    'directory': '/tmp/minion-profiles'
+}
+
+def profiler_config(cfg):
+    config = dict(DEFAULT_PROFILER_CONFIG)
+    config.update(cfg.get('profiler', {}))
+    return config
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s:%s" % (frame.f_globals.get('__name__', os.path.basename(code.co_filename)), code.co_name)
+
+def _folded_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def _safe_name(name):
+    return "".join(c if c.isalnum() or c in '-_.' else '_' for c in name).strip('_') or 'root'
+
+class SamplingProfiler:
+
+    def __init__(self, interval, flush_interval, directory):
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._labels = {}
+        self._samples = collections.defaultdict(collections.Counter)
+        self._running = False
+        self._thread = None
+        self._last_flush = time.time()
+
+    @property
+    def running(self):
+        return self._running
+
+    # Threads mark what they are working on so that samples can be
+    # attributed to a route or task name.
+
+    def enter(self, label):
+        self._labels[threading.current_thread().ident] = label
+
+    def leave(self):
+        self._labels.pop(threading.current_thread().ident, None)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="minion-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.flush()
+
+    def toggle(self):
+        if self._running:
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self):
+        labels = dict(self._labels)
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, label in labels.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._samples[label][_folded_stack(frame)] += 1
+
+    def flush(self):
+        with self._lock:
+            samples, self._samples = self._samples, collections.defaultdict(collections.Counter)
+            self._last_flush = time.time()
+        if not samples:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for label, stacks in samples.items():
+            path = os.path.join(self.directory, "%s.%d.folded" % (_safe_name(label), os.getpid()))
+            with open(path, "a") as f:
+                for stack, count in stacks.items():
+                    f.write("%s;%s %d\n" % (label, stack, count))
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+                if time.time() - self._last_flush >= self.flush_interval:
+                    self.flush()
+            except Exception:
+                pass
+
+profiler = None
+
+def install_profiler(cfg):
+    """ Create the process wide profiler, start it if the configuration
+    says so and let SIGUSR2 toggle it. Returns the profiler. """
+    global profiler
+    if profiler is None:
+        config = profiler_config(cfg)
+        profiler = SamplingProfiler(config['interval'], config['flush_interval'], config['directory'])
+        if config['enabled']:
+            profiler.start()
+        try:
+            signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            pass
+    return profiler
+
+def init_profiler(app, cfg):
+    """ Attribute samples taken in the API process to the route being served. """
+    from flask import request
+    p = install_profiler(cfg)
+    @app.before_request
+    def enter_profiler():
+        if p.running:
+            rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            p.enter("%s %s" % (request.method, rule))
+    @app.teardown_request
+    def leave_profiler(exception=None):
+        p.leave()
@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+#
+# Progress messages of plugin sessions are coalesced so that a chatty
+# plugin does not flood the state queue. The interval is configured in the
+# 'plugin_worker' section of backend.json:
+#
+#   "plugin_worker": { "progress_interval": 5 }
+#
+# The last progress before a session finishes is always persisted.
+#
+
+class ProgressThrottle:
+
+    """
+    Coalesces the progress messages of a plugin session. Only the most
+    recent progress is kept and it is handed to the callback at most once
+    every interval seconds. A pending update can be pushed out immediately
+    with flush(), for example right before the session finishes.
+    """
+
+    def __init__(self, interval, callback):
+        self._interval = interval
+        self._callback = callback
+        self._pending = None
+        self._last_sent = None
+
+    def update(self, progress, now=None):
+        self._pending = progress
+        self.poll(now)
+
+    def poll(self, now=None):
+        now = now if now is not None else time.time()
+        if self._pending is None:
+            return
+        if self._last_sent is not None and now - self._last_sent < self._interval:
+            return
+        self._send(now)
+
+    def flush(self, now=None):
+        if self._pending is not None:
+            self._send(now if now is not None else time.time())
+
+    def _send(self, now):
+        progress, self._pending = self._pending, None
+        self._last_sent = now
+        self._callback(progress)
+
+def progress_interval(cfg):
+    return cfg.get('plugin_worker', {}).get('progress_interval', 5)
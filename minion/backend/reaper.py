@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import socket
+import threading
+import time
+
+#
+# Workers hold leases on the scans and sessions they run. The scan worker
+# keeps meta.lease of its scan fresh and the plugin worker does the same
+# for the lease of its session:
+#
+#   "lease": { "worker": "scanner1.example.org:4242",
+#              "expires": <datetime> }
+#
+# Leases are renewed every lease_ttl / 3 seconds through the state queue.
+# When a worker dies its leases expire and the reaper, which runs every
+# interval seconds in the state worker, recovers the work:
+#
+#  - A STARTED session with an expired lease is marked FAILED. The scan
+#    worker notices that while it waits for the session and moves on.
+#  - A STARTED scan with an expired lease is requeued: its unfinished
+#    sessions go back to CREATED and the scan becomes a pending scan again
+#    that the scheduler dispatches to another scan worker. Sessions that
+#    already finished keep their results and do not run again. After
+#    max_requeues attempts, or with the "fail" policy, the scan is marked
+#    FAILED instead.
+#
+# It is configured in the 'reaper' section of backend.json:
+#
+#   "reaper": { "lease_ttl": 120,
+#               "interval": 60,
+#               "scan_policy": "requeue",       # or "fail"
+#               "max_requeues": 1 }
+#
+# Scans and sessions without a lease, like those started before leases
+# existed, are left alone.
+#
+
+DEFAULT_REAPER_CONFIG = {
+    'lease_ttl': 120,
+    'interval': 60,
+    'scan_policy': 'requeue',
+    'max_requeues': 1
+}
+
+SCAN_POLICIES = ('requeue', 'fail')
+
+# Sessions that a dead worker left behind
+UNFINISHED_STATES = ('QUEUED', 'STARTED')
+
+def reaper_config(cfg):
+    config = dict(DEFAULT_REAPER_CONFIG)
+    config.update(cfg.get('reaper', {}))
+    return config
+
+def worker_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+class LeaseKeeper:
+
+    """
+    Renews a lease from a background thread, right away and then every
+    ttl / 3 seconds until stop() is called. renew is called with the new
+    expiry time of the lease as a timestamp.
+    """
+
+    def __init__(self, ttl, renew):
+        self.ttl = ttl
+        self._renew = renew
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._renew(time.time() + self.ttl)
+            self._stopped.wait(self.ttl / 3.0)
+
+def orphaned_scans(scans, now):
+    """ Return the running scans whose scan worker stopped renewing its lease. """
+    return list(scans.find({'state': 'STARTED', 'meta.lease.expires': {'$lt': now}}))
+
+def orphaned_sessions(scans, now):
+    """ Return (scan, session) pairs for the running sessions whose plugin
+    worker stopped renewing its lease. """
+    orphans = []
+    for scan in scans.find({'state': 'STARTED',
+                            'sessions': {'$elemMatch': {'state': 'STARTED', 'lease.expires': {'$lt': now}}}}):
+        for session in scan['sessions']:
+            if session['state'] == 'STARTED' and session.get('lease') and session['lease']['expires'] < now:
+                orphans.append((scan, session))
+    return orphans
+
+def _reset_session(session):
+    session = dict(session, state='CREATED', queued=None, started=None, finished=None, progress=None, issues=[])
+    for field in ('lease', '_task', 'failure'):
+        session.pop(field, None)
+    return session
+
+def requeue_scan(scans, scan):
+    """ Make an orphaned scan pending again, with its unfinished sessions
+    reset. Returns False if the scan changed since it was found. """
+    sessions = [_reset_session(s) if s['state'] in UNFINISHED_STATES else s for s in scan['sessions']]
+    requeued = scans.find_and_modify({'id': scan['id'], 'state': 'STARTED',
+                                      'meta.lease.expires': scan['meta']['lease']['expires']},
+                                     {'$set': {'state': 'QUEUED',
+                                               'started': None,
+                                               'sessions': sessions,
+                                               'meta.dispatched': None},
+                                      '$unset': {'meta.lease': 1},
+                                      '$inc': {'meta.requeues': 1}})
+    return requeued is not None
+
+def claim_scan(scans, scan):
+    """ Take an orphaned scan away from its lease so that only one reaper
+    fails it. Returns False if the scan changed since it was found. """
+    return scans.find_and_modify({'id': scan['id'], 'state': 'STARTED',
+                                  'meta.lease.expires': scan['meta']['lease']['expires']},
+                                 {'$unset': {'meta.lease': 1}}) is not None
+
+def fail_session(scans, scan_id, session, failure, now):
+    """ Mark an orphaned session as FAILED. Returns False if the session
+    changed since it was found. """
+    return scans.find_and_modify({'id': scan_id,
+                                  'sessions': {'$elemMatch': {'id': session['id'], 'state': 'STARTED',
+                                                              'lease.expires': session['lease']['expires']}}},
+                                 {'$set': {'sessions.$.state': 'FAILED',
+                                           'sessions.$.finished': now,
+                                           'sessions.$.failure': failure}}) is not None
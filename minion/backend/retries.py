@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+
+#
+# Retry policies for plugin sessions. When a session ends in a state or
+# with a failure reason that its policy lists in retry_on, the scan worker
+# waits and runs the same session again, up to max_attempts runs in total.
+# The wait doubles after each attempt, starting at backoff seconds and
+# capped at max_backoff.
+#
+# Policies are configured in the 'retry' section of backend.json. The top
+# level is the default policy, which does not retry at all, and plugins
+# can have a policy of their own by plugin class:
+#
+#   "retry": { "max_attempts": 1,
+#              "backoff": 30,
+#              "max_backoff": 300,
+#              "retry_on": ["FAILED", "TERMINATED", "plugin-worker-lost"],
+#              "plugins": {
+#                "minion.plugins.garmr.GarmrPlugin": { "max_attempts": 3 } } }
+#
+# A session is reset to QUEUED for every new attempt. The attempts before
+# the last one are kept in the attempts list of the session:
+#
+#   "attempts": [ { "state": "FAILED", "failure": {...}, "issues": 1,
+#                   "queued": ..., "started": ..., "finished": ... } ]
+#
+# Stopped and aborted sessions are never retried, and neither are sessions
+# that would be retried after the scan runs out of its time budget.
+#
+# Once a scan has ended, PUT /scans/<id>/control with RERUN_FAILED runs the
+# sessions that did not finish (FAILED, STOPPED, CANCELLED, TERMINATED and
+# TIMEOUT, or still CREATED) once more. Those are reset to CREATED, with
+# their last run added to their attempts, and the scan is queued again.
+# Finished sessions keep their results and are skipped by the scan worker.
+#
+
+DEFAULT_RETRY_CONFIG = {
+    'max_attempts': 1,
+    'backoff': 30,
+    'max_backoff': 300,
+    'retry_on': ['FAILED', 'TERMINATED', 'plugin-worker-lost'],
+    'plugins': {}
+}
+
+NEVER_RETRIED = ('FINISHED', 'STOPPED', 'ABORTED')
+
+RERUN_STATES = ('FAILED', 'STOPPED', 'CANCELLED', 'TERMINATED', 'TIMEOUT')
+
+def retry_config(cfg):
+    config = dict(DEFAULT_RETRY_CONFIG)
+    config.update(cfg.get('retry', {}))
+    return config
+
+def plugin_policy(config, plugin_class):
+    """ Return the retry policy of a plugin: the default policy with the
+    settings of the plugin on top. """
+    policy = dict((k, v) for k, v in config.items() if k != 'plugins')
+    policy.update(config['plugins'].get(plugin_class, {}))
+    return policy
+
+def should_retry(policy, attempt, state, failure=None):
+    """ Return True if a session that ended in state, with failure, after
+    its attempt-th run should run again. """
+    if state in NEVER_RETRIED or attempt >= policy['max_attempts']:
+        return False
+    reason = (failure or {}).get('reason')
+    return state in policy['retry_on'] or (reason is not None and reason in policy['retry_on'])
+
+def retry_delay(policy, attempt):
+    """ Return the seconds to wait before the run after the attempt-th. """
+    return min(policy['backoff'] * 2 ** (attempt - 1), policy['max_backoff'])
+
+def attempt_record(session):
+    """ Return the record of the last run of a session for its attempts. """
+    return {'state': session['state'],
+            'failure': session.get('failure'),
+            'issues': len(session['issues']),
+            'queued': session['queued'],
+            'started': session['started'],
+            'finished': session['finished']}
+
+def rerun_sessions(sessions):
+    """ Return the sessions with the ones that did not finish reset to
+    CREATED, and the number of sessions that will run again. That includes
+    sessions that never left CREATED because the scan ended early. """
+    reset = []
+    for session in sessions:
+        if session['state'] in RERUN_STATES:
+            attempts = session.get('attempts', []) + [attempt_record(session)]
+            session = dict(session, state='CREATED', queued=None, started=None, finished=None,
+                           progress=None, issues=[], attempts=attempts)
+            for field in ('failure', 'lease', '_task'):
+                session.pop(field, None)
+        reset.append(session)
+    return reset, len([s for s in sessions if s['state'] in RERUN_STATES + ('CREATED',)])
+
+def rerun_scan(scans, scan, sessions, tenant):
+    """ Queue an ended scan again with sessions from rerun_sessions().
+    Returns False if the scan changed since it was loaded. The lease and
+    requeue count of the previous run go, so the reaper does not take the
+    new run for an orphan. A campaign scan stays counted once. """
+    return scans.find_and_modify({"id": scan['id'], "state": scan['state']},
+                                 {"$set": {"state": "QUEUED",
+                                           "queued": datetime.datetime.utcnow(),
+                                           "started": None,
+                                           "finished": None,
+                                           "sessions": sessions,
+                                           "meta.tenant": tenant,
+                                           "meta.dispatched": None,
+                                           "meta.requeues": 0},
+                                  "$unset": {"failure": 1,
+                                             "meta.lease": 1}}) is not None
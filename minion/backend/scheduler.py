@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+
+from celery.execute import send_task
+
+from minion.backend.tracing import tracer
+
+#
+# Fair share scheduling of scans between tenants. A tenant is the user that
+# owns the scan (meta.user) or the group the target belongs to.
+#
+# Starting a scan no longer sends it to the scan queue right away. The scan
+# is marked QUEUED with meta.dispatched set to None and then dispatch() is
+# called. It sends pending scans to the scan queue, each time picking the
+# tenant with the lowest number of running scans relative to its weight, as
+# long as the tenant and the whole system are below their caps. dispatch()
+# runs again whenever a scan finishes or is stopped.
+#
+# It is configured in the 'scheduler' section of backend.json:
+#
+#   "scheduler": { "tenant": "group",        # or "user"
+#                  "max_running": 50,        # scans running at once, all tenants
+#                  "tenant_cap": 10,         # default cap per tenant
+#                  "caps": { "cron": 5 },    # caps for specific tenants
+#                  "weights": { "security": 2 } }
+#
+# All caps default to unlimited, in which case scans are dispatched as soon
+# as they are started, like before. Caps are best effort when several
+# processes dispatch at the same moment; a scan itself is only ever
+# dispatched once because it is claimed with an atomic update.
+#
+# Scans also have a priority, kept in meta.priority. Scans started by a
+# person are 'interactive', scans of the batch users (the scheduled scans
+# run as 'cron') are 'batch'. Pending interactive scans are dispatched
+# before pending batch scans, except that batch scans always get at least
+# batch_min_share of max_running. With batch_queues enabled, batch scans
+# and their plugin sessions also go to separate queues (scan-batch,
+# plugin-batch, ...) so that they never sit in front of interactive work
+# in the broker. Those queues need their own workers, see
+# scripts/minion-scan-worker and scripts/minion-plugin-worker.
+#
+#   "scheduler": { "batch_users": ["cron"],
+#                  "batch_min_share": 0.25,
+#                  "batch_queues": true }
+#
+# Pending scans wait in mongodb, not in the broker, so with max_running
+# set the broker never holds more scans than that. The pending backlog
+# itself is bounded by max_pending: when it is full the API refuses to
+# create or start more scans with a 503 and a Retry-After of retry_after
+# seconds until capacity frees up.
+#
+#   "scheduler": { "max_pending": 1000,
+#                  "retry_after": 30 }
+#
+
+DEFAULT_SCHEDULER_CONFIG = {
+    'tenant': 'user',
+    'max_running': None,
+    'tenant_cap': None,
+    'caps': {},
+    'weights': {},
+    'batch_users': ['cron'],
+    'batch_min_share': 0.25,
+    'batch_queues': False,
+    'max_pending': None,
+    'retry_after': 30,
+    'duplicates': 'queue'
+}
+
+ACTIVE_STATES = ('QUEUED', 'STARTED', 'STOPPING')
+
+PRIORITIES = ('interactive', 'batch')
+
+def scheduler_config(cfg):
+    config = dict(DEFAULT_SCHEDULER_CONFIG)
+    config.update(cfg.get('scheduler', {}))
+    return config
+
+def tenant_cap(config, tenant):
+    return config['caps'].get(tenant, config['tenant_cap'])
+
+def tenant_weight(config, tenant):
+    return float(config['weights'].get(tenant, 1))
+
+def tenant_for_scan(scan, groups, config):
+    """ Return the tenant a scan is accounted to. With group tenancy that
+    is the first group, by name, that contains the target. """
+    if config['tenant'] == 'group':
+        for group in groups.find({'sites': scan['configuration']['target']}).sort('name', 1).limit(1):
+            return group['name']
+    return scan['meta']['user']
+
+def scan_priority(user, requested, config):
+    """ Return the priority of a new scan: the requested one or else
+    batch for the batch users and interactive for everybody else. """
+    if requested is not None:
+        return requested
+    return 'batch' if user in config['batch_users'] else 'interactive'
+
+def queue_for_priority(queue, priority, config):
+    """ Return the queue for scan or plugin tasks of the given priority. """
+    if priority == 'batch' and config['batch_queues']:
+        return queue + '-batch'
+    return queue
+
+def _is_pending(scan):
+    # Scans that were queued before the scheduler existed have no
+    # meta.dispatched at all. Those were sent to the scan queue already.
+    return scan['state'] == 'QUEUED' and 'dispatched' in scan['meta'] and scan['meta']['dispatched'] is None
+
+def pending_count(scans):
+    return scans.find({'state': 'QUEUED', 'meta.dispatched': {'$type': 10}}).count()
+
+def admit(scans, config, count=1):
+    """ Return True if the pending backlog has room for count more scans. """
+    return config['max_pending'] is None or pending_count(scans) + count <= config['max_pending']
+
+def _load(scans):
+    """ Return the number of running scans of each tenant and of each
+    priority, and the pending scans, oldest first, of each (priority,
+    tenant) pair. """
+    running, running_priorities, pending = {}, {}, {}
+    fields = {'id': 1, 'state': 1, 'meta': 1, 'queued': 1, 'configuration.target': 1, 'plan.name': 1}
+    for scan in scans.find({'state': {'$in': ACTIVE_STATES}}, fields).sort('queued', 1):
+        tenant = scan['meta'].get('tenant', scan['meta'].get('user'))
+        priority = scan['meta'].get('priority', 'interactive')
+        if _is_pending(scan):
+            pending.setdefault((priority, tenant), []).append((scan['queued'], scan))
+        else:
+            running[tenant] = running.get(tenant, 0) + 1
+            running_priorities[priority] = running_priorities.get(priority, 0) + 1
+    return running, running_priorities, pending
+
+def _priority_order(running_priorities, config):
+    """ Interactive first, unless batch is below its guaranteed share. """
+    if config['max_running'] is not None:
+        if running_priorities.get('batch', 0) < config['batch_min_share'] * config['max_running']:
+            return ('batch', 'interactive')
+    return ('interactive', 'batch')
+
+def start_scan(scan_id, priority, config):
+    # No delay needed: the scan was marked QUEUED and claimed with
+    # acknowledged writes before it gets here, so the scan worker always
+    # finds it in the right state.
+    send_task("minion.backend.tasks.scan", [scan_id, tracer.start_trace()],
+              queue=queue_for_priority('scan', priority, config))
+
+def dispatch(scans, config, start=start_scan, acquire=None):
+    """ Send as many pending scans to the scan queue as the caps allow.
+    Returns the ids of the scans that were dispatched. If given, acquire
+    is called with a scan before it is dispatched and the scan is skipped
+    unless it returns the id of the scan, see minion.backend.leases. """
+    running, running_priorities, pending = _load(scans)
+    total = sum(running.values())
+    dispatched = []
+    while pending:
+        if config['max_running'] is not None and total >= config['max_running']:
+            break
+        for priority in _priority_order(running_priorities, config):
+            eligible = [(p, t) for p, t in pending if p == priority and
+                        (tenant_cap(config, t) is None or running.get(t, 0) < tenant_cap(config, t))]
+            if eligible:
+                break
+        else:
+            break
+        # Lowest weighted usage first, the tenant that waited longest on a tie
+        key = min(eligible, key=lambda k: (running.get(k[1], 0) / tenant_weight(config, k[1]), pending[k][0][0]))
+        queued, scan = pending[key].pop(0)
+        scan_id = scan['id']
+        if not pending[key]:
+            del pending[key]
+        if acquire is not None and acquire(scan) != scan_id:
+            # Another scan of the same target and plan is in flight
+            continue
+        claimed = scans.find_and_modify({'id': scan_id, 'state': 'QUEUED', 'meta.dispatched': {'$type': 10}},
+                                        {'$set': {'meta.dispatched': datetime.datetime.utcnow()}})
+        if claimed is None:
+            # Dispatched by another process or stopped in the meantime
+            continue
+        priority, tenant = key
+        start(scan_id, priority, config)
+        running[tenant] = running.get(tenant, 0) + 1
+        running_priorities[priority] = running_priorities.get(priority, 0) + 1
+        total += 1
+        dispatched.append(scan_id)
+    return dispatched
+
+def share_usage(scans, config):
+    """ Return the running and pending scans of every tenant that has any,
+    together with its cap, weight and share of the running scans. """
+    running, running_priorities, pending = _load(scans)
+    total = sum(running.values())
+    waiting = {}
+    for (priority, tenant), scan_ids in pending.items():
+        waiting[tenant] = waiting.get(tenant, 0) + len(scan_ids)
+    usage = []
+    for tenant in sorted(set(running.keys()) | set(waiting.keys())):
+        usage.append({'tenant': tenant,
+                      'running': running.get(tenant, 0),
+                      'pending': waiting.get(tenant, 0),
+                      'cap': tenant_cap(config, tenant),
+                      'weight': tenant_weight(config, tenant),
+                      'share': float(running.get(tenant, 0)) / total if total else 0.0})
+    return usage
@@ -16,19 +16,24 @@ import uuid
 
 from celery import Celery
 from celery.app.control import Control
-from celery.exceptions import TaskRevokedError
+from celery.exceptions import TaskRevokedError, TimeoutError
 from celery.execute import send_task
-from celery.signals import celeryd_after_setup
+from celery.signals import celeryd_after_setup, task_postrun, task_prerun, worker_process_init
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
 from pymongo import MongoClient
 import requests
+import requests.adapters
 from twisted.internet import reactor
 from twisted.internet.error import ProcessDone, ProcessTerminated, ProcessExitedAlready
 from twisted.internet.protocol import ProcessProtocol
 
-from minion.backend import ownership
+from minion.backend import budgets, callbacks, campaigns, leases, ownership, profiler, reaper, retries, scheduler, tracing
+from minion.backend.mongo import InstrumentedCollection
+from minion.backend.progress import ProgressThrottle, progress_interval
+from minion.backend.tracing import tracer
 from minion.backend.utils import backend_config, scan_config, scannable
+from minion.backend.watchdog import Watchdog, watchdog_config, watchdog_failure
 
 
 cfg = backend_config()
@@ -39,17 +44,71 @@ celery = Celery('tasks', broker=cfg['celery']['broker'], backend=cfg['celery']['
 if cfg.get('mongodb') is not None:
     mongodb = MongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
     db = mongodb.minion
-    plans = db.plans
-    scans = db.scans
+    plans = InstrumentedCollection(db.plans)
+    scans = InstrumentedCollection(db.scans)
+    campaignz = InstrumentedCollection(db.campaigns)
+    scan_leases = InstrumentedCollection(db.scan_leases)
+    leases.ensure_indexes(scan_leases)
+    callback_slots = db.callback_slots
+    callbacks.ensure_indexes(callback_slots)
 
 logger = get_task_logger(__name__)
 
+#
+# The sampling profiler is installed in each worker process and attributes
+# its samples to the name of the task that is running.
+#
+
+@worker_process_init.connect
+def install_profiler(**kwargs):
+    profiler.install_profiler(cfg)
+
+@task_prerun.connect
+def enter_profiler(task=None, **kwargs):
+    if profiler.profiler is not None and profiler.profiler.running:
+        profiler.profiler.enter(task.name)
+
+@task_postrun.connect
+def leave_profiler(**kwargs):
+    if profiler.profiler is not None:
+        profiler.profiler.leave()
+
 
 def find_session(scan, session_id):
     for session in scan['sessions']:
         if session['id'] == session_id:
             return session
 
+#
+# A scan that finishes or stops gives up its lease and frees up capacity
+# for its tenant and its campaign, so give the scheduler a chance to
+# release and dispatch pending scans.
+#
+
+SCHEDULER_CONFIG = scheduler.scheduler_config(cfg)
+
+def acquire_lease(scan):
+    return leases.acquire(scan_leases, scans, scan)
+
+def dispatch_pending_scans():
+    try:
+        acquire = None if SCHEDULER_CONFIG['duplicates'] == 'allow' else acquire_lease
+        scheduler.dispatch(scans, SCHEDULER_CONFIG, acquire=acquire)
+    except Exception as e:
+        logger.exception("(Ignored) failure while dispatching pending scans")
+
+def release_lease(scan_id):
+    try:
+        leases.release(scan_leases, scan_id)
+    except Exception as e:
+        logger.exception("(Ignored) failure while releasing the lease of scan %s" % scan_id)
+
+def end_campaign_scan(scan, state):
+    try:
+        campaigns.scan_ended(campaignz, scans, scan, state)
+    except Exception as e:
+        logger.exception("(Ignored) failure while updating the campaign of scan %s" % scan['id'])
+
 
 @celery.task
 def scan_start(scan_id, t):
@@ -57,23 +116,120 @@ def scan_start(scan_id, t):
                  {"$set": {"state": "STARTED",
                            "started": datetime.datetime.utcfromtimestamp(t)}})
 
+#
+# Workers renew the leases of the scans and sessions they run through the
+# state queue. The reaper runs in the state worker, scheduled by its
+# embedded beat, and recovers the work of workers that are gone.
+#
+
+REAPER_CONFIG = reaper.reaper_config(cfg)
+
+celery.conf.update(CELERYBEAT_SCHEDULE={
+    'reap-orphans': { 'task': 'minion.backend.tasks.reap_orphans',
+                      'schedule': datetime.timedelta(seconds=REAPER_CONFIG['interval']),
+                      'options': {'queue': 'state'} }
+})
+
+@celery.task(ignore_result=True)
+def scan_renew_lease(scan_id, expires, worker):
+    scans.update({"id": scan_id, "state": "STARTED"},
+                 {"$set": {"meta.lease": {"worker": worker,
+                                          "expires": datetime.datetime.utcfromtimestamp(expires)}}})
+
+@celery.task(ignore_result=True)
+def session_renew_lease(scan_id, session_id, expires, worker):
+    scans.update({"id": scan_id, "sessions": {"$elemMatch": {"id": session_id, "state": "STARTED"}}},
+                 {"$set": {"sessions.$.lease": {"worker": worker,
+                                                "expires": datetime.datetime.utcfromtimestamp(expires)}}})
+
+def renew_lease(task_name, args):
+    # Renewals are not waited for, the next one follows soon enough
+    try:
+        send_task("minion.backend.tasks." + task_name, args + [reaper.worker_id()], queue='state')
+    except Exception as e:
+        logger.exception("(Ignored) failure while renewing lease with %s" % task_name)
+
+def worker_lost_failure(reason, message):
+    return {"hostname": socket.gethostname(),
+            "reason": reason,
+            "message": message}
+
+@celery.task(ignore_result=True)
+def reap_orphans():
+
+    now = datetime.datetime.utcnow()
+
+    #
+    # Scans first, a dead scan worker takes its sessions along
+    #
+
+    for scan in reaper.orphaned_scans(scans, now):
+        requeues = scan['meta'].get('requeues', 0)
+        if REAPER_CONFIG['scan_policy'] == 'requeue' and requeues < REAPER_CONFIG['max_requeues']:
+            if not reaper.requeue_scan(scans, scan):
+                continue
+            logger.warning("Scan %s lost its scan worker %s, requeued" % (scan['id'], scan['meta']['lease']['worker']))
+        else:
+            if not reaper.claim_scan(scans, scan):
+                continue
+            logger.warning("Scan %s lost its scan worker %s, marking it FAILED" % (scan['id'], scan['meta']['lease']['worker']))
+            for session in scan['sessions']:
+                if session['state'] in reaper.UNFINISHED_STATES:
+                    session_finish(scan['id'], session['id'], 'FAILED', time.time(),
+                                   worker_lost_failure("plugin-worker-lost", "The scan worker running this session went away."))
+            scan_finish(scan['id'], 'FAILED', time.time(),
+                        worker_lost_failure("scan-worker-lost", "The scan worker running this scan went away."))
+        for session in scan['sessions']:
+            if session['state'] in reaper.UNFINISHED_STATES and '_task' in session:
+                revoke(session['_task'], terminate=True, signal='SIGUSR1')
+
+    #
+    # Then sessions of scans that are still running fine
+    #
+
+    for scan, session in reaper.orphaned_sessions(scans, now):
+        failure = worker_lost_failure("plugin-worker-lost", "The plugin worker running this session went away.")
+        if reaper.fail_session(scans, scan['id'], session, failure, now):
+            logger.warning("Session %s/%s lost its plugin worker %s, marked it FAILED" % (scan['id'], session['id'], session['lease']['worker']))
+            if '_task' in session:
+                revoke(session['_task'], terminate=True, signal='SIGUSR1')
+
+    dispatch_pending_scans()
+
+
+def retry_after(response):
+    """ Return the seconds to wait if the API refused a scan because its
+    backlog is full, otherwise None. """
+    if response.status_code == 503:
+        return int(response.headers.get('retry-after', SCHEDULER_CONFIG['retry_after']))
+
+@celery.task(max_retries=None)
+def run_scheduled_scan(target, plan, scan_id=None):
+
+    #
+    # When the API pushes back because too many scans are pending we try
+    # again later, without creating the scan again if it already exists.
+    #
 
-@celery.task
-def run_scheduled_scan(target, plan):
     #1: First create a scan
-    data = {
-        'plan': plan,
-        'configuration': {'target': target},
-        'user': 'cron'
-      } 
-
-    r = requests.post(cfg['api']['url'] + "/scans", 
-        headers={'Content-Type':'application/json'},
-        data=json.dumps(data));
-    r.raise_for_status()
-    scan_id = r.json()['scan']['id']
+    if scan_id is None:
+        data = {
+            'plan': plan,
+            'configuration': {'target': target},
+            'user': 'cron'
+          } 
+
+        r = requests.post(cfg['api']['url'] + "/scans", 
+            headers={'Content-Type':'application/json'},
+            data=json.dumps(data));
+        countdown = retry_after(r)
+        if countdown is not None:
+            logger.info("Scheduled scan postponed %ds - Target:%s Plan:%s" % (countdown, target, plan))
+            raise run_scheduled_scan.retry(args=[target, plan], countdown=countdown)
+        r.raise_for_status()
+        scan_id = r.json()['scan']['id']
     
-    logger.debug("Scheduled scan created - Target:" + target + " Plan:" + plan + " Request result: " + str(r.status_code))
+        logger.debug("Scheduled scan created - Target:" + target + " Plan:" + plan + " Request result: " + str(r.status_code))
     
     #2: Start the scan
     q = requests.put(cfg['api']['url'] + "/scans/" + scan_id + "/control",
@@ -81,10 +237,14 @@ def run_scheduled_scan(target, plan):
         data="START",
         params={"email":'cron'});
 
+    countdown = retry_after(q)
+    if countdown is not None:
+        logger.info("Scheduled scan %s start postponed %ds" % (scan_id, countdown))
+        raise run_scheduled_scan.retry(args=[target, plan], kwargs={'scan_id': scan_id}, countdown=countdown)
     q.raise_for_status()
     logger.debug("Scheduled scan STARTED - Target:" + target + " Plan:" + plan + "  result: " + str(q.status_code))
     
-    return "Scan scheduled: " + scan_id + " r:" + str(r.status_code) + " q:"+ str(q.status_code)
+    return "Scan scheduled: " + scan_id + " q:"+ str(q.status_code)
 
 
 
@@ -102,6 +262,15 @@ def scan_finish(scan_id, state, t, failure=None):
             logger.error("Cannot find scan %s" % scan_id)
             return
 
+        #
+        # A scan that is being stopped cannot finish as anything else than
+        # stopped, scan_stop takes care of it
+        #
+
+        if state == 'FINISHED' and scan['state'] in STOP_STATES:
+            logger.info("Scan %s is %s, not marking it FINISHED" % (scan_id, scan['state']))
+            return
+
         #
         # Mark the scan as finished with the provided state
         #
@@ -112,22 +281,26 @@ def scan_finish(scan_id, state, t, failure=None):
                                    "finished": datetime.datetime.utcfromtimestamp(t),
                                    "failure": failure}})
         else:
-            scans.update({"id": scan_id},
+            spec = {"id": scan_id}
+            if state == 'FINISHED':
+                spec["state"] = {"$nin": STOP_STATES}
+            scans.update(spec,
                          {"$set": {"state": state,
                                    "finished": datetime.datetime.utcfromtimestamp(t)}})
 
         #
-        # Fire the callback
+        # Queue the callback. It is delivered by the callback worker so that a slow
+        # or unreachable endpoint does not hold up the state worker.
         #
 
         try:
             callback = scan['configuration'].get('callback')
             if callback:
-                r = requests.post(callback['url'], headers={"Content-Type": "application/json"},
-                                  data=json.dumps({'event': 'scan-state', 'id': scan['id'], 'state': state}))
-                r.raise_for_status()
+                send_task("minion.backend.tasks.deliver_callback",
+                          [callback['url'], {'event': 'scan-state', 'id': scan['id'], 'state': state}],
+                          queue='callback')
         except Exception as e:
-            logger.exception("(Ignored) failure while calling scan state callback for scan %s" % scan['id'])
+            logger.exception("(Ignored) failure while queueing scan state callback for scan %s" % scan['id'])
 
         #
         # If there are remaining plugin sessions that are still in the CREATED state
@@ -140,6 +313,10 @@ def scan_finish(scan_id, state, t, failure=None):
                 scans.update({"id": scan_id, "sessions.id": s['id']},
                              {"$set": {"sessions.$.state": "CANCELLED"}})
 
+        release_lease(scan_id)
+        end_campaign_scan(scan, state)
+        dispatch_pending_scans()
+
     except Exception as e:
 
         logger.exception("Error while finishing scan. Trying to mark scan as FAILED.")
@@ -151,6 +328,81 @@ def scan_finish(scan_id, state, t, failure=None):
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
+#
+# Callback delivery, see minion.backend.callbacks
+#
+
+CALLBACK_CONFIG = callbacks.callback_config(cfg)
+
+callback_session = None
+
+def get_callback_session():
+    global callback_session
+    if callback_session is None:
+        callback_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=CALLBACK_CONFIG['pool_size'],
+                                                pool_maxsize=CALLBACK_CONFIG['pool_size'])
+        callback_session.mount('http://', adapter)
+        callback_session.mount('https://', adapter)
+    return callback_session
+
+def record_callback(delivery_id, url, event, state, attempts, status_code=None, latency=None, error=None):
+    db.callbacks.update({'id': delivery_id},
+                        {'$set': {'url': url,
+                                  'event': event,
+                                  'state': state,
+                                  'attempts': attempts,
+                                  'status_code': status_code,
+                                  'latency': latency,
+                                  'error': error,
+                                  'updated': datetime.datetime.utcnow()}},
+                        upsert=True)
+
+def requeue_callback(url, event, delivery_id, attempt, countdown):
+    send_task("minion.backend.tasks.deliver_callback",
+              [url, event, delivery_id, attempt],
+              queue='callback', countdown=countdown)
+
+def retry_callback(url, event, delivery_id, attempt, status_code, latency, error):
+    countdown = callbacks.retry_countdown(attempt, CALLBACK_CONFIG)
+    if countdown is None:
+        logger.error("Giving up on callback to %s after %d attempts: %s" % (url, attempt + 1, error))
+        record_callback(delivery_id, url, event, 'FAILED', attempt + 1, status_code, latency, error)
+        return
+    logger.warning("Callback to %s failed (attempt %d): %s" % (url, attempt + 1, error))
+    record_callback(delivery_id, url, event, 'RETRYING', attempt + 1, status_code, latency, error)
+    requeue_callback(url, event, delivery_id, attempt + 1, countdown)
+
+@celery.task(ignore_result=True)
+def deliver_callback(url, event, delivery_id=None, attempt=0):
+
+    delivery_id = delivery_id or str(uuid.uuid4())
+    endpoint = callbacks.callback_endpoint(url)
+
+    #
+    # Respect the per-endpoint concurrency limit. If the endpoint is busy then
+    # try again later, which counts as an attempt.
+    #
+
+    slot = callbacks.acquire_slot(callback_slots, endpoint, delivery_id,
+                                  CALLBACK_CONFIG['max_concurrency'], CALLBACK_CONFIG['slot_ttl'])
+    if slot is None:
+        return retry_callback(url, event, delivery_id, attempt, None, None, 'endpoint-busy')
+
+    status_code = None
+    start = time.time()
+    try:
+        r = get_callback_session().post(url, headers={"Content-Type": "application/json"},
+                                        data=json.dumps(event), timeout=CALLBACK_CONFIG['timeout'])
+        status_code = r.status_code
+        r.raise_for_status()
+    except Exception as e:
+        return retry_callback(url, event, delivery_id, attempt, status_code, time.time() - start, str(e))
+    finally:
+        callbacks.release_slot(callback_slots, endpoint, slot, delivery_id)
+
+    record_callback(delivery_id, url, event, 'DELIVERED', attempt + 1, status_code, time.time() - start)
+
 @celery.task
 def scan_stop(scan_id):
 
@@ -183,6 +435,10 @@ def scan_stop(scan_id):
             if '_task' in session:
                 revoke(session['_task'], terminate=True, signal='SIGUSR1')
 
+        release_lease(scan_id)
+        end_campaign_scan(scan, 'STOPPED')
+        dispatch_pending_scans()
+
     except Exception as e:
 
         logger.exception("Error while processing task. Marking scan as FAILED.")
@@ -215,19 +471,49 @@ def session_report_issue(scan_id, session_id, issue):
     scans.update({"id": scan_id, "sessions.id": session_id},
                  {"$push": {"sessions.$.issues": issue}})
 
+@celery.task
+def session_report_progress(scan_id, session_id, progress):
+    scans.update({"id": scan_id, "sessions.id": session_id},
+                 {"$set": {"sessions.$.progress": progress}})
+
 @celery.task
 def session_finish(scan_id, session_id, state, t, failure=None):
+    # A session that timed out is stopped by the scan worker. The STOPPED
+    # that the plugin worker reports after that must not hide the TIMEOUT.
+    # Likewise a plugin worker that reports on a session the reaper reset
+    # to CREATED is too late, only the scan worker cancels those.
+    ignored = ["TIMEOUT"] if state == "CANCELLED" else ["TIMEOUT", "CREATED"]
+    spec = {"id": scan_id, "sessions": {"$elemMatch": {"id": session_id, "state": {"$nin": ignored}}}}
     if failure:
-        scans.update({"id": scan_id, "sessions.id": session_id},
+        scans.update(spec,
                      {"$set": {"sessions.$.state": state,
                                "sessions.$.finished": datetime.datetime.utcfromtimestamp(t),
                                "sessions.$.failure": failure}})
     else:
-        scans.update({"id": scan_id, "sessions.id": session_id},
+        scans.update(spec,
                      {"$set": {"sessions.$.state": state,
                                "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}})
 
 
+@celery.task
+def session_retry(scan_id, session_id, t):
+    # Keep a record of the attempt that just ended and queue the session
+    # again with a clean slate
+    scan = scans.find_one({"id": scan_id})
+    session = find_session(scan, session_id) if scan else None
+    if session is None:
+        logger.error("Cannot find session %s/%s" % (scan_id, session_id))
+        return
+    scans.update({"id": scan_id, "sessions.id": session_id},
+                 {"$push": {"sessions.$.attempts": retries.attempt_record(session)},
+                  "$set": {"sessions.$.state": "QUEUED",
+                           "sessions.$.queued": datetime.datetime.utcfromtimestamp(t),
+                           "sessions.$.started": None,
+                           "sessions.$.finished": None,
+                           "sessions.$.progress": None,
+                           "sessions.$.issues": []},
+                  "$unset": {"sessions.$.failure": 1,
+                             "sessions.$.lease": 1}})
 
 
 # plugin_worker
@@ -359,16 +645,25 @@ def get_scan(api_url, scan_id):
     j = r.json()
     return j['scan']
 
+def get_scan_control(api_url, scan_id):
+    r = requests.get(api_url + "/scans/" + scan_id + "/control")
+    r.raise_for_status()
+    return r.json()
+
 def get_site_info(api_url, url):
     r = requests.get(api_url + '/sites', params={'url': url})
     r.raise_for_status()
     j = r.json()
     return j['sites'][0]
 
-def set_finished(scan_id, state, failure=None):
-    send_task("minion.backend.tasks.scan_finish",
-              [scan_id, state, time.time(), failure],
-              queue='state').get()
+def update_state(task_name, args, trace=None):
+    # Run a state task and wait for it to complete. With tracing enabled
+    # the round trip is recorded as a persist span.
+    with tracer.span(trace, "persist", task=task_name):
+        return send_task("minion.backend.tasks." + task_name, args, queue='state').get()
+
+def set_finished(scan_id, state, failure=None, trace=None):
+    update_state("scan_finish", [scan_id, state, time.time(), failure], trace)
 
 #
 # run_plugin
@@ -379,11 +674,45 @@ def find_session(scan, session_id):
         if session['id'] == session_id:
             return session
 
+# How often running scans and plugin sessions check if their scan is
+# being stopped, in seconds
+STOP_CHECK_INTERVAL = 1
+
+STOP_STATES = ('STOPPING', 'STOPPED')
+
+class StopCheck:
+
+    """
+    Tells whether a scan is being stopped, asking the API at most once
+    every interval seconds. Once stopped, always stopped.
+    """
+
+    def __init__(self, interval, scan_id):
+        self._interval = interval
+        self._scan_id = scan_id
+        self._last_checked = None
+        self._stopped = False
+
+    def stopped(self, now=None):
+        now = now if now is not None else time.time()
+        if self._stopped or (self._last_checked is not None and now - self._last_checked < self._interval):
+            return self._stopped
+        self._last_checked = now
+        try:
+            self._stopped = get_scan_control(cfg['api']['url'], self._scan_id)['state'] in STOP_STATES
+        except Exception as e:
+            logger.exception("(Ignored) failure while checking if scan %s is stopping" % self._scan_id)
+        return self._stopped
+
 @celery.task
-def run_plugin(scan_id, session_id):
+def run_plugin(scan_id, session_id, trace=None):
 
     logger.debug("This is run_plugin " + str(scan_id) + " " + str(session_id))
 
+    tracer.record_queue_wait(trace, "plugin.queue_wait", scan_id=scan_id, session_id=session_id)
+
+    lease = None
+
     try:
 
         #
@@ -397,7 +726,7 @@ def run_plugin(scan_id, session_id):
             return
 
         if scan['state'] in ('STOPPING', 'STOPPED'):
-            return
+            return "STOPPED"
 
         if scan['state'] != 'STARTED':
             logger.error("Scan %s has invalid state. Expected STARTED but got %s" % (scan_id, scan['state']))
@@ -420,12 +749,63 @@ def run_plugin(scan_id, session_id):
         #
         # Move the session in the STARTED state
         #
-        send_task("minion.backend.tasks.session_start",
-                  [scan_id, session_id, time.time()],
-                  queue='state').get()
+        update_state("session_start", [scan_id, session_id, time.time()], trace)
+
+        #
+        # Hold a lease on the session for as long as the plugin runs
+        #
+
+        lease = reaper.LeaseKeeper(REAPER_CONFIG['lease_ttl'],
+                                   lambda expires: renew_lease("session_renew_lease", [scan_id, session_id, expires]))
+        lease.start()
 
         finished = None
 
+        #
+        # Progress messages are coalesced so that a chatty plugin does not flood
+        # the state queue. Only the latest progress is persisted, at most once
+        # every progress_interval seconds.
+        #
+
+        def report_progress(progress):
+            update_state("session_report_progress", [scan_id, session_id, progress], trace)
+
+        progress = ProgressThrottle(progress_interval(cfg), report_progress)
+
+        #
+        # The watchdog stops, and if needed kills, a plugin runner that hangs
+        #
+
+        inactivity_timeout, max_runtime, kill_grace = watchdog_config(cfg)
+        watchdog = Watchdog(inactivity_timeout, max_runtime, kill_grace)
+        reported = False
+
+        #
+        # Stop the plugin runner as soon as the scan is being stopped, without
+        # waiting for the revoke of this task to come around
+        #
+
+        stop_check = StopCheck(STOP_CHECK_INTERVAL, scan_id)
+        stop_sent = []
+
+        def check_stop():
+            if not stop_sent and stop_check.stopped():
+                logger.info("Scan %s is stopping, stopping session %s" % (scan_id, session_id))
+                stop_sent.append(True)
+                try:
+                    p.send_signal(signal.SIGUSR1)
+                except OSError:
+                    pass
+
+        def check_watchdog():
+            signum = watchdog.check()
+            if signum is not None:
+                logger.warning("Session %s/%s %s, sending signal %d" % (scan_id, session_id, watchdog.reason, signum))
+                try:
+                    p.send_signal(signum)
+                except OSError:
+                    pass
+
         #
         # This is an experiment to see if removing Twisted makes the celery workers more stable.
         #
@@ -449,7 +829,10 @@ def run_plugin(scan_id, session_id):
                       "-c", json.dumps(session['configuration']),
                       "-p", session['plugin']['class'],
                       "-s", session_id ]
+        if trace is not None:
+            arguments += ["-t", trace['trace_id']]
 
+        plugin_started = time.time()
         p = subprocess.Popen(arguments, bufsize=1, stdout=subprocess.PIPE, close_fds=True)
 
         signal.signal(signal.SIGUSR1, make_signal_handler(p))
@@ -466,45 +849,60 @@ def run_plugin(scan_id, session_id):
                     break
 
                 line = line.strip()
+                watchdog.activity()
 
                 if finished is not None:
                     logger.error("Plugin emitted (ignored) message after finishing: " + line)
-                    return
+                    return finished
 
                 msg = json.loads(line)
 
                 # Issue: persist it
                 if msg['msg'] == 'issue':
-                    send_task("minion.backend.tasks.session_report_issue",
-                              args=[scan_id, session_id, msg['data']],
-                              queue='state').get()
+                    update_state("session_report_issue", [scan_id, session_id, msg['data']], trace)
 
-                # Progress: update the progress
+                # Progress: remember it, the throttle decides when to persist it
                 if msg['msg'] == 'progress':
-                    pass # TODO
+                    progress.update(msg['data'])
 
                 # Finish: update the session state, wait for the plugin runner to finish, return the state
                 if msg['msg'] == 'finish':
+                    progress.flush()
                     finished = msg['data']['state']
-                    if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], session['id'], msg['data']['state'], time.time()],
-                                  queue='state').get()
+                    # A plugin stopped by the watchdog is recorded as TERMINATED below
+                    if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED') and not watchdog.triggered:
+                        update_state("session_finish", [scan['id'], session['id'], msg['data']['state'], time.time()], trace)
+                        reported = True
 
             except Queue.Empty:
-                pass
+                progress.poll()
+
+            check_watchdog()
+            check_stop()
+
+        progress.flush()
 
+        # The runner closed its output, make sure it also exits
+        while p.poll() is None:
+            check_watchdog()
+            time.sleep(0.25)
         return_code = p.wait()
 
+        failure = watchdog_failure(watchdog, reported)
+        if failure is not None:
+            update_state("session_finish", [scan['id'], session['id'], 'TERMINATED', time.time(), failure], trace)
+            finished = 'TERMINATED'
+
+        tracer.record(trace, "plugin.run", plugin_started, time.time(), scan_id=scan_id,
+                      session_id=session_id, plugin=session['plugin']['class'], state=finished)
+
         signal.signal(signal.SIGUSR1, signal.SIG_DFL)
 
         if not finished:
             failure = { "hostname": socket.gethostname(),
                         "message": "The plugin did not finish correctly",
                         "exception": None }
-            send_task("minion.backend.tasks.session_finish",
-                      [scan['id'], session['id'], 'FAILED', time.time(), failure],
-                      queue='state').get()
+            update_state("session_finish", [scan['id'], session['id'], 'FAILED', time.time(), failure], trace)
 
         return finished
 
@@ -522,14 +920,17 @@ def run_plugin(scan_id, session_id):
             failure = { "hostname": socket.gethostname(),
                         "message": str(e),
                         "exception": traceback.format_exc() }
-            send_task("minion.backend.tasks.session_finish",
-                      [scan_id, session_id, "FAILED", time.time(), failure],
-                      queue='state').get()
+            update_state("session_finish", [scan_id, session_id, "FAILED", time.time(), failure], trace)
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
         return "FAILED"
 
+    finally:
+
+        if lease is not None:
+            lease.stop()
+
 
 
 
@@ -547,6 +948,94 @@ def get_scan(api_url, scan_id):
     j = r.json()
     return j['scan']
 
+BUDGET_CONFIG = budgets.budget_config(cfg)
+
+# How long to wait for a plugin worker to let go of a session that ran out
+# of its budget and was told to stop
+SESSION_STOP_GRACE = 15
+
+def stop_timed_out_session(scan_id, session, result, trace):
+    """ Mark the session as TIMEOUT and stop the plugin. """
+    failure = {"hostname": socket.gethostname(),
+               "reason": "session-budget-exceeded",
+               "message": "The plugin session ran out of its time budget and was stopped."}
+    update_state("session_finish", [scan_id, session['id'], "TIMEOUT", time.time(), failure], trace)
+    revoke(result.id, terminate=True, signal='SIGUSR1')
+    try:
+        result.get(timeout=SESSION_STOP_GRACE)
+    except Exception as e:
+        logger.warning("Session %s/%s did not stop within %d seconds" % (scan_id, session['id'], SESSION_STOP_GRACE))
+    return "TIMEOUT"
+
+def wait_for_plugin(scan_id, session_id, result, timeout):
+    """ Wait for the result of a plugin session, like result.get(timeout).
+    Every STOP_CHECK_INTERVAL seconds check if the scan is being stopped,
+    in which case the plugin is stopped as well, or if the reaper gave up
+    on the session because its plugin worker went away. Either way return
+    the state the session ended in. """
+    deadline = time.time() + timeout if timeout is not None else None
+    while True:
+        poll = STOP_CHECK_INTERVAL
+        if deadline is not None:
+            remaining = deadline - time.time()
+            # A timeout of 0 means no timeout at all to the result backend
+            if remaining <= 0:
+                raise TimeoutError("The session ran out of time")
+            poll = min(poll, remaining)
+        try:
+            return result.get(timeout=poll)
+        except TimeoutError:
+            if deadline is not None and time.time() >= deadline:
+                raise
+        try:
+            control = get_scan_control(cfg['api']['url'], scan_id)
+        except Exception as e:
+            logger.exception("(Ignored) failure while checking on session %s/%s" % (scan_id, session_id))
+            continue
+        if control['state'] in STOP_STATES:
+            revoke(result.id, terminate=True, signal='SIGUSR1')
+            return "STOPPED"
+        session = find_session(control, session_id)
+        if session is not None and session['state'] not in reaper.UNFINISHED_STATES:
+            return session['state']
+
+RETRY_CONFIG = retries.retry_config(cfg)
+
+def sleep_unless_stopped(scan_id, seconds):
+    """ Sleep, checking every STOP_CHECK_INTERVAL seconds if the scan is
+    being stopped. Returns True as soon as it is. """
+    stop_check = StopCheck(STOP_CHECK_INTERVAL, scan_id)
+    end = time.time() + seconds
+    while time.time() < end:
+        time.sleep(max(min(STOP_CHECK_INTERVAL, end - time.time()), 0))
+        if stop_check.stopped():
+            return True
+    return False
+
+def retry_session(scan_id, session, policy, attempt, state, deadline, trace):
+    """ Decide if a session that just ended in state should run again. If
+    so wait for the backoff, queue the session for its next attempt and
+    return None. Otherwise return the state the session ended in, which is
+    STOPPED if the scan was stopped in the meantime. """
+    if state in retries.NEVER_RETRIED or attempt >= policy['max_attempts']:
+        return state
+    scan = get_scan(cfg['api']['url'], scan_id)
+    if scan['state'] in STOP_STATES:
+        return "STOPPED"
+    if scan['state'] != 'STARTED':
+        return state
+    current = find_session(scan, session['id'])
+    if not retries.should_retry(policy, attempt, state, current.get('failure')):
+        return state
+    delay = retries.retry_delay(policy, attempt)
+    if deadline.expired(time.time() + delay):
+        return state
+    logger.info("Session %s/%s ended %s, attempt %d of %d, retrying in %ds" %
+                (scan_id, session['id'], state, attempt, policy['max_attempts'], delay))
+    if sleep_unless_stopped(scan_id, delay):
+        return "STOPPED"
+    update_state("session_retry", [scan_id, session['id'], time.time()], trace)
+
 def queue_for_session(session, cfg):
     queue = 'plugin'
     if 'plugin_worker_queues' in cfg:
@@ -555,8 +1044,29 @@ def queue_for_session(session, cfg):
             queue = cfg['plugin_worker_queues'][weight]
     return queue
 
+def finish_timed_out_scan(scan, trace):
+    """ Cancel the sessions that did not run and finish the scan as TIMEOUT. """
+    for s in scan['sessions']:
+        if s['state'] == 'CREATED':
+            s['state'] = 'CANCELLED'
+            update_state("session_finish", [scan['id'], s['id'], "CANCELLED", time.time()], trace)
+    failure = {"hostname": socket.gethostname(),
+               "reason": "scan-budget-exceeded",
+               "message": "The scan ran out of its time budget."}
+    update_state("scan_finish", [scan['id'], "TIMEOUT", time.time(), failure], trace)
+
 @celery.task(ignore_result=True)
-def scan(scan_id):
+def scan(scan_id, trace=None):
+
+    #
+    # Everything this task does is recorded as a child of the scan span
+    #
+
+    tracer.record_queue_wait(trace, "scan.queue_wait", scan_id=scan_id)
+    scan_started, scan_span = time.time(), tracing.new_id()
+    parent, trace = trace, tracer.child(trace, scan_span)
+
+    lease = None
 
     try:
 
@@ -582,9 +1092,15 @@ def scan(scan_id):
         #
 
         scan['state'] = 'STARTED'
-        send_task("minion.backend.tasks.scan_start",
-                  [scan_id, time.time()],
-                  queue='state').get()
+        update_state("scan_start", [scan_id, time.time()], trace)
+
+        #
+        # Hold a lease on the scan for as long as we run it
+        #
+
+        lease = reaper.LeaseKeeper(REAPER_CONFIG['lease_ttl'],
+                                   lambda expires: renew_lease("scan_renew_lease", [scan_id, expires]))
+        lease.start()
 
         #
         # Check this site against the access control lists
@@ -596,7 +1112,7 @@ def scan(scan_id):
             failure = {"hostname": socket.gethostname(),
                        "reason": "target-blacklisted",
                        "message": "The target cannot be scanned by Minion because its (IPv4) address has been blacklisted."}
-            return set_finished(scan_id, 'ABORTED', failure=failure)
+            return set_finished(scan_id, 'ABORTED', failure=failure, trace=trace)
 
         #
         # Verify ownership prior to running scan
@@ -605,7 +1121,7 @@ def scan(scan_id):
         target = scan['configuration']['target']
         site = get_site_info(cfg['api']['url'], target)
         if not site:
-            return set_finished(scan_id, 'ABORTED')
+            return set_finished(scan_id, 'ABORTED', trace=trace)
 
         if site.get('verification') and site['verification']['enabled']:
             verified = ownership.verify(target, site['verification']['value'])
@@ -613,44 +1129,88 @@ def scan(scan_id):
                 failure = {"hostname": socket.gethostname(),
                            "reason": "target-ownership-verification-failed",
                            "message": "The target cannot be scanned because the ownership verification failed."}
-                return set_finished(scan_id, 'ABORTED', failure=failure)
+                return set_finished(scan_id, 'ABORTED', failure=failure, trace=trace)
 
         #
-        # Run each plugin session
+        # Run each plugin session, within the time budgets of the scan
         #
 
+        deadline = budgets.Deadline(scan['meta'].get('budget'), BUDGET_CONFIG, scan_started)
+
         for session in scan['sessions']:
 
-            #
-            # Mark the session as QUEUED
-            #
+            # A scan that was requeued by the reaper only runs the
+            # sessions that had not finished yet
+            if session['state'] != 'CREATED':
+                continue
 
-            session['state'] = 'QUEUED'
-            #scans.update({"id": scan['id'], "sessions.id": session['id']}, {"$set": {"sessions.$.state": "QUEUED", "sessions.$.queued": datetime.datetime.utcnow()}})
-            send_task("minion.backend.tasks.session_queue",
-                      [scan['id'], session['id'], time.time()],
-                      queue='state').get()
+            if deadline.expired():
+                return finish_timed_out_scan(scan, trace)
 
-            #
-            # Execute the plugin. The plugin worker will set the session state and issues.
-            #
+            policy = retries.plugin_policy(RETRY_CONFIG, session['plugin']['class'])
+            attempt = 1
 
-            logger.info("Scan %s running plugin %s" % (scan['id'], session['plugin']['class']))
+            while True:
 
-            queue = queue_for_session(session, cfg)
-            result = send_task("minion.backend.tasks.run_plugin",
-                               [scan_id, session['id']],
-                               queue=queue)
+                #
+                # Do not start another plugin for a scan that is being stopped
+                #
 
-            #scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$._task": result.id}})
-            send_task("minion.backend.tasks.session_set_task_id",
-                      [scan_id, session['id'], result.id],
-                      queue='state').get()
+                if StopCheck(STOP_CHECK_INTERVAL, scan_id).stopped():
+                    plugin_result = "STOPPED"
+                    break
 
-            try:
-                plugin_result = result.get()
-            except TaskRevokedError as e:
-                plugin_result = "STOPPED"
+                #
+                # Mark the session as QUEUED
+                #
+
+                session['state'] = 'QUEUED'
+                if attempt == 1:
+                    #scans.update({"id": scan['id'], "sessions.id": session['id']}, {"$set": {"sessions.$.state": "QUEUED", "sessions.$.queued": datetime.datetime.utcnow()}})
+                    update_state("session_queue", [scan['id'], session['id'], time.time()], trace)
+
+                #
+                # Execute the plugin. The plugin worker will set the session state and issues.
+                #
+
+                logger.info("Scan %s running plugin %s" % (scan['id'], session['plugin']['class']))
+
+                queue = scheduler.queue_for_priority(queue_for_session(session, cfg),
+                                                     scan['meta'].get('priority', 'interactive'),
+                                                     SCHEDULER_CONFIG)
+                # Record the task id first, so that a stop always finds it
+                task_id = str(uuid.uuid4())
+                update_state("session_set_task_id", [scan_id, session['id'], task_id], trace)
+
+                session_started = time.time()
+                result = send_task("minion.backend.tasks.run_plugin",
+                                   [scan_id, session['id'], tracer.child(trace)],
+                                   queue=queue, task_id=task_id)
+
+                try:
+                    plugin_result = wait_for_plugin(scan_id, session['id'], result, deadline.session_timeout(session['id']))
+                except TaskRevokedError as e:
+                    plugin_result = "STOPPED"
+                except TimeoutError as e:
+                    plugin_result = stop_timed_out_session(scan_id, session, result, trace)
+
+                # The plugin worker skips sessions of scans and sessions that
+                # are no longer runnable, which happens when the scan stops
+                if plugin_result is None:
+                    plugin_result = "STOPPED"
+
+                tracer.record(trace, "session", session_started, time.time(), scan_id=scan_id,
+                              session_id=session['id'], plugin=session['plugin']['class'], state=plugin_result, attempt=attempt)
+
+                #
+                # Transient failures are retried according to the retry policy of the plugin
+                #
+
+                ended = retry_session(scan_id, session, policy, attempt, plugin_result, deadline, trace)
+                if ended is not None:
+                    plugin_result = ended
+                    break
+                attempt += 1
 
             session['state'] = plugin_result
 
@@ -661,29 +1221,26 @@ def scan(scan_id):
             if plugin_result in ('ABORTED', 'STOPPED'):
                 # Mark the scan as failed
                 #scans.update({"id": scan_id}, {"$set": {"state": plugin_result, "finished": datetime.datetime.utcnow()}})
-                send_task("minion.backend.tasks.scan_finish",
-                          [scan_id, plugin_result, time.time()],
-                          queue='state').get()
+                update_state("scan_finish", [scan_id, plugin_result, time.time()], trace)
                 # Mark all remaining sessions as cancelled
                 for s in scan['sessions']:
                     if s['state'] == 'CREATED':
                         s['state'] = 'CANCELLED'
                         #scans.update({"id": scan['id'], "sessions.id": s['id']}, {"$set": {"sessions.$.state": "CANCELLED", "sessions.$.finished": datetime.datetime.utcnow()}})
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], s['id'], "CANCELLED", time.time()],
-                                  queue='state').get()
+                        update_state("session_finish", [scan['id'], s['id'], "CANCELLED", time.time()], trace)
                 # We are done with this scan
                 return
 
+            if plugin_result == 'TIMEOUT' and deadline.expired():
+                return finish_timed_out_scan(scan, trace)
+
         #
         # Move the scan to the FINISHED state
         #
 
         scan['state'] = 'FINISHED'
         #scans.update({"id": scan_id}, {"$set": {"state": "FINISHED", "finished": datetime.datetime.utcnow()}})
-        send_task("minion.backend.tasks.scan_finish",
-                  [scan_id, "FINISHED", time.time()],
-                  queue='state').get()
+        update_state("scan_finish", [scan_id, "FINISHED", time.time()], trace)
 
     except Exception as e:
 
@@ -700,8 +1257,13 @@ def scan(scan_id):
                         "reason": "backend-exception",
                         "message": str(e),
                         "exception": traceback.format_exc() }
-            send_task("minion.backend.tasks.scan_finish",
-                      [scan_id, "FAILED", time.time(), failure],
-                      queue='state').get()
+            update_state("scan_finish", [scan_id, "FAILED", time.time(), failure], trace)
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
+
+    finally:
+
+        if lease is not None:
+            lease.stop()
+
+        tracer.record(parent, "scan", scan_started, time.time(), span_id=scan_span, scan_id=scan_id)
@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+import datetime
+import uuid
+
+from minion.backend import budgets
+
+#
+# Plans are compiled once into a scan template: the plugin descriptors,
+# step configurations, descriptions and budgets that every scan of the plan
+# shares. Creating a scan is then a copy of the template plus new ids.
+#
+# Plans carry a revision that starts at 1 and goes up with every update.
+# Scans record the revision of the plan they were created from. Templates
+# are cached per process by plan name and are rebuilt when the plan they
+# were compiled from has a different _id or revision, so updates made
+# through other API processes are picked up as well. Plans from before
+# revisions existed count as revision 0.
+#
+# Templates are never modified after they are compiled. The configuration
+# of a new session is a new dict, but values nested in it are shared with
+# the template and must not be changed in place.
+#
+
+class ScanTemplate:
+
+    def __init__(self, plan, plugins):
+        self.key = (plan.get('_id'), plan.get('revision', 0))
+        self.name = plan['name']
+        self.revision = plan.get('revision', 0)
+        self._budgets = {'budget': plan.get('budget'),
+                         'workflow': [{'budget': step.get('budget')} for step in plan['workflow']]}
+        self._steps = [{'plugin': plugins[step['plugin_name']]['descriptor'],
+                        'configuration': copy.deepcopy(step['configuration']),
+                        'description': step['description']}
+                       for step in plan['workflow']]
+
+    def new_scan(self, configuration, user, priority, budget=None):
+        now = datetime.datetime.utcnow()
+        scan = { "id": str(uuid.uuid4()),
+                 "state": "CREATED",
+                 "created": now,
+                 "queued": None,
+                 "started": None,
+                 "finished": None,
+                 "plan": { "name": self.name, "revision": self.revision },
+                 "configuration": configuration,
+                 "sessions": [],
+                 "meta": { "user": user,
+                           "tags": [],
+                           "priority": priority } }
+        for step in self._steps:
+            session_configuration = dict(step['configuration'])
+            session_configuration.update(configuration)
+            session = { "id": str(uuid.uuid4()),
+                        "state": "CREATED",
+                        "plugin": step['plugin'],
+                        "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
+                        "description": step['description'],
+                        "artifacts": {},
+                        "issues": [],
+                        "created": now,
+                        "queued": None,
+                        "started": None,
+                        "finished": None,
+                        "progress": None }
+            scan['sessions'].append(session)
+        scan['meta']['budget'] = budgets.scan_budget(self._budgets, scan['sessions'], budget)
+        return scan
+
+_templates = {}
+
+def template_for(plan, plugins):
+    """ Return the template for a plan document, compiling it if the
+    cached one is missing or out of date. """
+    template = _templates.get(plan['name'])
+    if template is None or template.key != (plan.get('_id'), plan.get('revision', 0)):
+        template = _templates[plan['name']] = ScanTemplate(plan, plugins)
+    return template
+
+def invalidate(plan_name):
+    _templates.pop(plan_name, None)
@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo import MongoClient
+
+from minion.backend.utils import backend_config
+
+#
+# Lightweight tracing of a scan through the API, the scan worker, the plugin
+# workers, the plugin runner and the state worker.
+#
+# A trace context is a small dict that is passed along with every task:
+#
+#   { "trace_id": "...",  # one per scan start
+#     "span_id": "...",   # the span that sent the task, the parent of the next spans
+#     "sent": 1381234.5 } # when the task was sent, to compute the queue wait
+#
+# Finished spans are written to a collector configured in the 'tracing'
+# section of backend.json:
+#
+#   "tracing": { "enabled": true,
+#                "collector": "file",              # or "mongodb"
+#                "path": "/tmp/minion-spans.json" }
+#
+# The file collector appends one JSON document per line. The mongodb
+# collector inserts into the minion.spans collection; processes without
+# mongodb configuration (plugin workers) fall back to the file collector.
+#
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACING_CONFIG = {
+    'enabled': False,
+    'collector': 'file',
+    'path': '/tmp/minion-spans.json'
+}
+
+def tracing_config(cfg):
+    config = dict(DEFAULT_TRACING_CONFIG)
+    config.update(cfg.get('tracing', {}))
+    return config
+
+def new_id():
+    return uuid.uuid4().hex
+
+class FileCollector:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def collect(self, span):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(span) + "\n")
+
+class MongoCollector:
+
+    def __init__(self, host, port):
+        self.spans = MongoClient(host=host, port=port).minion.spans
+
+    def collect(self, span):
+        self.spans.insert(dict(span))
+
+class Tracer:
+
+    def __init__(self, config, collector):
+        self.enabled = config['enabled']
+        self.collector = collector
+        self.hostname = socket.gethostname()
+
+    def start_trace(self):
+        """ Create the context for a new trace. """
+        return {'trace_id': new_id(), 'span_id': None, 'sent': time.time()}
+
+    def child(self, context, span_id=None):
+        """ Create the context to send along with a task, as a child of
+        span_id or of the span that sent the current task. """
+        if context is None:
+            return None
+        return {'trace_id': context['trace_id'],
+                'span_id': span_id or context.get('span_id'),
+                'sent': time.time()}
+
+    def record(self, context, name, start, end, span_id=None, **attributes):
+        if not self.enabled or context is None:
+            return
+        span = {'trace_id': context['trace_id'],
+                'span_id': span_id or new_id(),
+                'parent_id': context.get('span_id'),
+                'name': name,
+                'start': start,
+                'end': end,
+                'duration': end - start,
+                'hostname': self.hostname,
+                'pid': os.getpid(),
+                'attributes': attributes}
+        try:
+            self.collector.collect(span)
+        except Exception as e:
+            logger.exception("Failed to collect span %s" % name)
+
+    def record_queue_wait(self, context, name, **attributes):
+        """ Record the time between sending a task and picking it up. """
+        if context is not None and context.get('sent') is not None:
+            self.record(context, name, context['sent'], time.time(), **attributes)
+
+    @contextlib.contextmanager
+    def span(self, context, name, **attributes):
+        """ Time the enclosed block. Yields the context to pass to work
+        started from within the block so that it becomes a child span. """
+        span_id = new_id()
+        start = time.time()
+        try:
+            yield self.child(context, span_id)
+        finally:
+            self.record(context, name, start, time.time(), span_id=span_id, **attributes)
+
+def create_tracer(cfg):
+    config = tracing_config(cfg)
+    if config['collector'] == 'mongodb' and cfg.get('mongodb') is not None:
+        collector = MongoCollector(cfg['mongodb']['host'], cfg['mongodb']['port'])
+    else:
+        collector = FileCollector(config['path'])
+    return Tracer(config, collector)
+
+tracer = create_tracer(backend_config())
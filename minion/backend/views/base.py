@@ -12,6 +12,7 @@ from flask import abort, Flask, jsonify, request, session
 from pymongo import MongoClient
 
 from minion.backend.app import app
+from minion.backend.mongo import InstrumentedCollection
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.plugins.base import AbstractPlugin
@@ -19,14 +20,16 @@ from minion.plugins.base import AbstractPlugin
 backend_config = backend_utils.backend_config()
 
 mongo_client = MongoClient(host=backend_config['mongodb']['host'], port=backend_config['mongodb']['port'])
-invites = mongo_client.minion.invites
-groups = mongo_client.minion.groups
-plans = mongo_client.minion.plans
-scans = mongo_client.minion.scans
-sites = mongo_client.minion.sites
-users = mongo_client.minion.users
-scanschedules = mongo_client.minion.scanschedule
-siteCredentials = mongo_client.minion.siteCredentials
+campaigns = InstrumentedCollection(mongo_client.minion.campaigns)
+invites = InstrumentedCollection(mongo_client.minion.invites)
+groups = InstrumentedCollection(mongo_client.minion.groups)
+plans = InstrumentedCollection(mongo_client.minion.plans)
+scans = InstrumentedCollection(mongo_client.minion.scans)
+scan_leases = InstrumentedCollection(mongo_client.minion.scan_leases)
+sites = InstrumentedCollection(mongo_client.minion.sites)
+users = InstrumentedCollection(mongo_client.minion.users)
+scanschedules = InstrumentedCollection(mongo_client.minion.scanschedule)
+siteCredentials = InstrumentedCollection(mongo_client.minion.siteCredentials)
 
 def api_guard(*decor_args):
     """ Decorate a view function to be protected by requiring
@@ -116,6 +119,12 @@ def sanitize_session(session):
     for field in ('created', 'queued', 'started', 'finished'):
         if session.get(field) is not None:
             session[field] = calendar.timegm(session[field].utctimetuple())
+    if session.get('lease') is not None:
+        session['lease']['expires'] = calendar.timegm(session['lease']['expires'].utctimetuple())
+    for attempt in session.get('attempts', []):
+        for field in ('queued', 'started', 'finished'):
+            if attempt.get(field) is not None:
+                attempt[field] = calendar.timegm(attempt[field].utctimetuple())
     return session
 
 def sanitize_time(t):
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import calendar
+import uuid
+from flask import jsonify, request
+
+from minion.backend import campaigns as campaign_utils
+from minion.backend import scheduler
+from minion.backend.app import app
+from minion.backend.views.base import api_guard, campaigns, groups, plans, scans
+from minion.backend.views.scans import SCHEDULER_CONFIG, _build_scan, _dispatch, _over_capacity
+
+def sanitize_campaign(campaign):
+    if '_id' in campaign:
+        del campaign['_id']
+    for field in ('created', 'finished'):
+        if campaign.get(field) is not None:
+            campaign[field] = calendar.timegm(campaign[field].utctimetuple())
+    return campaign
+
+#
+# Start a campaign that runs a plan against every site in a group
+#
+#  POST /groups/<group_name>/campaigns
+#
+#  { "plan": "basic",
+#    "user": "bob@example.org",
+#    "max_concurrency": 5 }
+#
+# The scans are created right away and released max_concurrency at a
+# time. Returns the campaign:
+#
+#  { "success": true,
+#    "campaign": { "id": "...", "group": "security", "plan": "basic",
+#                  "state": "RUNNING", "total": 120, "done": 0, ... } }
+#
+
+@app.route('/groups/<group_name>/campaigns', methods=['POST'])
+@api_guard('application/json')
+def create_campaign(group_name):
+    body = request.json or {}
+    group = groups.find_one({'name': group_name})
+    if not group:
+        return jsonify(success=False, reason='no-such-group')
+    plan = plans.find_one({'name': body.get('plan')})
+    if not plan:
+        return jsonify(success=False, reason='no-such-plan')
+    if not body.get('user'):
+        return jsonify(success=False, reason='no-user')
+    max_concurrency = body.get('max_concurrency', campaign_utils.DEFAULT_MAX_CONCURRENCY)
+    if not isinstance(max_concurrency, int) or max_concurrency < 1:
+        return jsonify(success=False, reason='invalid-max-concurrency')
+    priority = body.get('priority')
+    if priority is not None and priority not in scheduler.PRIORITIES:
+        return jsonify(success=False, reason='invalid-priority')
+    priority = scheduler.scan_priority(body['user'], priority, SCHEDULER_CONFIG)
+    sitez = group.get('sites', [])
+    refused = _over_capacity(min(len(sitez), max_concurrency))
+    if refused is not None:
+        return refused
+    campaign_id = str(uuid.uuid4())
+    scanz = []
+    for site in sitez:
+        scan = _build_scan(plan, {'target': site}, body['user'], priority)
+        scan['meta']['campaign'] = campaign_id
+        scan['meta']['tenant'] = scheduler.tenant_for_scan(scan, groups, SCHEDULER_CONFIG)
+        scanz.append(scan)
+    campaign = campaign_utils.new_campaign(campaign_id, group_name, plan['name'], body['user'],
+                                           [scan['id'] for scan in scanz], max_concurrency)
+    campaigns.insert(campaign)
+    if scanz:
+        scans.insert(scanz)
+        campaign_utils.release(campaigns, scans, campaign_id)
+        _dispatch()
+    return jsonify(success=True, campaign=sanitize_campaign(campaigns.find_one({'id': campaign_id})))
+
+#
+# List the campaigns of a group, most recent first, without their scan ids
+#
+#  GET /groups/<group_name>/campaigns
+#
+
+@app.route('/groups/<group_name>/campaigns', methods=['GET'])
+@api_guard
+def list_campaigns(group_name):
+    campaignz = campaigns.find({'group': group_name}, {'scans': 0}).sort('created', -1)
+    return jsonify(success=True, campaigns=[sanitize_campaign(c) for c in campaignz])
+
+#
+# Return the progress and aggregated results of a campaign
+#
+#  GET /groups/<group_name>/campaigns/<campaign_id>
+#
+
+@app.route('/groups/<group_name>/campaigns/<campaign_id>', methods=['GET'])
+@api_guard
+def get_campaign(group_name, campaign_id):
+    campaign = campaigns.find_one({'group': group_name, 'id': campaign_id})
+    if not campaign:
+        return jsonify(success=False, reason='no-such-campaign')
+    return jsonify(success=True, campaign=sanitize_campaign(campaign))
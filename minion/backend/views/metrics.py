@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+from flask import Response
+
+from minion.backend.app import app
+from minion.backend.metrics import registry
+from minion.backend.views.base import api_guard
+
+#
+# Return the metrics of this API process in the Prometheus text format
+#
+#  GET /metrics
+#
+
+@app.route('/metrics', methods=['GET'])
+@api_guard
+def get_metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -10,6 +10,7 @@ from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
+from minion.backend import budgets, templates
 from minion.backend.app import app
 from minion.backend.views.base import api_guard, plans, plugins, users, sites, groups
 
@@ -18,6 +19,7 @@ def _plan_description(plan):
         'description': plan['description'],
         'name': plan['name'],
         'workflow': plan['workflow'],
+        'revision': plan.get('revision', 0),
         'created' : plan['created'] }
 
 def get_plan_by_plan_name(plan_name):
@@ -90,6 +92,11 @@ def _check_plan_workflow(workflow):
             return False
         if not isinstance(plugin['configuration'], dict):
             return False
+        if not budgets.valid_budget(plugin.get('budget')):
+            return False
+        # Plugins that were loaded at startup need no import
+        if plugin['plugin_name'] in plugins:
+            continue
         try:
             _import_plugin(plugin['plugin_name'])
         except (AttributeError, ImportError):
@@ -149,6 +156,7 @@ def delete_plan(plan_name):
         return jsonify(success=False, reason="Plan does not exist.")
     # Remove the plan
     plans.remove({'name': plan_name})
+    templates.invalidate(plan_name)
     return jsonify(success=True)
 
 #
@@ -167,11 +175,17 @@ def create_plan():
     if not _check_plan_workflow(plan['workflow']):
         return jsonify(success=False, reason='invalid-plan-exists')
 
+    if not budgets.valid_budget(plan.get('budget')):
+        return jsonify(success=False, reason='invalid-budget')
+
     # Create the plan
     new_plan = { 'name': plan['name'],
                  'description': plan['description'],
                  'workflow': plan['workflow'],
+                 'revision': 1,
                  'created': datetime.datetime.utcnow() }
+    if plan.get('budget') is not None:
+        new_plan['budget'] = plan['budget']
     plans.insert(new_plan)
 
     # Return the new plan
@@ -200,7 +214,12 @@ def update_plan(plan_name):
         changes['description'] = new_plan['description']
     if 'workflow' in new_plan:
         changes['workflow'] = new_plan['workflow']
-    plans.update({'name': plan_name}, {'$set': changes})
+    if 'budget' in new_plan:
+        if not budgets.valid_budget(new_plan['budget']):
+            return jsonify(success=False, reason='invalid-budget')
+        changes['budget'] = new_plan['budget']
+    plans.update({'name': plan_name}, {'$set': changes, '$inc': {'revision': 1}})
+    templates.invalidate(plan_name)
     # Return the plan
     plan = plans.find_one({"name": plan_name})
     return jsonify(success=True, plan=sanitize_plan(plan))
@@ -216,6 +235,7 @@ def update_plan(plan_name):
 #  { "success": true,
 #    "plan": { "description": "Run an nmap scan",
 #               "name": "nmap",
+#               "revision": 2,
 #               "workflow": [ { "configuration": {},
 #                               "description": "Run the NMAP scanner.",
 #                               "plugin": { "version": "0.2",
@@ -141,3 +141,107 @@ def get_reports_issues():
                                                     'id': issue['Id']})
             result.append(r)
     return jsonify(success=True, report=result)
+
+#
+# Returns fleet wide queue wait and run time statistics, per plugin class
+# and for scans as a whole, computed with mongodb aggregation pipelines.
+# Only finished scans are taken into account. Accepts an optional filter:
+# since?=<unix timestamp>&plan_name?=<plan_name>. Durations are in seconds.
+# A since that is not a timestamp is answered with a 400 and reason
+# invalid-since.
+#
+#  { 'report':
+#       { 'scans': { 'count': 120, 'queue_wait': {'avg': 2.1, 'max': 30.2},
+#                    'run_time': {'avg': 60.3, 'max': 900.1},
+#                    'orchestration_overhead': {'avg': 1.4, 'max': 9.8} },
+#         'plugins': [ { 'plugin': 'minion.plugins.basic.AlivePlugin', 'count': 120,
+#                        'queue_wait': {'avg': 0.2, 'max': 12.0},
+#                        'run_time': {'avg': 1.3, 'max': 15.0} }, ... ] },
+#    'success': True }
+
+def _aggregate(collection, pipeline):
+    result = collection.aggregate(pipeline)
+    # pymongo 2.x returns the raw command response, newer versions a cursor
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+def _duration_stats(row, name):
+    return {'avg': row[name + '_avg'] / 1000.0 if row[name + '_avg'] is not None else None,
+            'max': row[name + '_max'] / 1000.0 if row[name + '_max'] is not None else None}
+
+def _timeline_match():
+    """ Return the filter for the scans in the report, or None if the
+    since argument is not a valid timestamp. """
+    match = {'state': 'FINISHED', 'started': {'$ne': None}, 'finished': {'$ne': None}}
+    since = request.args.get('since')
+    if since:
+        try:
+            match['created'] = {'$gte': datetime.datetime.utcfromtimestamp(float(since))}
+        except (ValueError, OverflowError):
+            return None
+    plan_name = request.args.get('plan_name')
+    if plan_name:
+        match['plan.name'] = plan_name
+    return match
+
+@app.route('/reports/timeline', methods=['GET'])
+@api_guard
+def get_reports_timeline():
+    match = _timeline_match()
+    if match is None:
+        response = jsonify(success=False, reason='invalid-since')
+        response.status_code = 400
+        return response
+    # Date subtraction in an aggregation pipeline returns milliseconds
+    scan_rows = _aggregate(scans, [
+        {'$match': match},
+        {'$unwind': '$sessions'},
+        {'$project': {'queue_wait': {'$subtract': ['$started', '$queued']},
+                      'run_time': {'$subtract': ['$finished', '$started']},
+                      'session_time': {'$subtract': ['$sessions.finished', '$sessions.queued']}}},
+        {'$group': {'_id': '$_id',
+                    'queue_wait': {'$first': '$queue_wait'},
+                    'run_time': {'$first': '$run_time'},
+                    'session_time': {'$sum': '$session_time'}}},
+        {'$project': {'queue_wait': 1,
+                      'run_time': 1,
+                      'orchestration_overhead': {'$subtract': ['$run_time', '$session_time']}}},
+        {'$group': {'_id': None,
+                    'count': {'$sum': 1},
+                    'queue_wait_avg': {'$avg': '$queue_wait'},
+                    'queue_wait_max': {'$max': '$queue_wait'},
+                    'run_time_avg': {'$avg': '$run_time'},
+                    'run_time_max': {'$max': '$run_time'},
+                    'orchestration_overhead_avg': {'$avg': '$orchestration_overhead'},
+                    'orchestration_overhead_max': {'$max': '$orchestration_overhead'}}}])
+    plugin_rows = _aggregate(scans, [
+        {'$match': match},
+        {'$unwind': '$sessions'},
+        {'$match': {'sessions.queued': {'$ne': None},
+                    'sessions.started': {'$ne': None},
+                    'sessions.finished': {'$ne': None}}},
+        {'$project': {'plugin': '$sessions.plugin.class',
+                      'queue_wait': {'$subtract': ['$sessions.started', '$sessions.queued']},
+                      'run_time': {'$subtract': ['$sessions.finished', '$sessions.started']}}},
+        {'$group': {'_id': '$plugin',
+                    'count': {'$sum': 1},
+                    'queue_wait_avg': {'$avg': '$queue_wait'},
+                    'queue_wait_max': {'$max': '$queue_wait'},
+                    'run_time_avg': {'$avg': '$run_time'},
+                    'run_time_max': {'$max': '$run_time'}}},
+        {'$sort': {'_id': 1}}])
+    report = {'scans': {'count': 0, 'queue_wait': None, 'run_time': None, 'orchestration_overhead': None},
+              'plugins': []}
+    if scan_rows:
+        row = scan_rows[0]
+        report['scans'] = {'count': row['count'],
+                           'queue_wait': _duration_stats(row, 'queue_wait'),
+                           'run_time': _duration_stats(row, 'run_time'),
+                           'orchestration_overhead': _duration_stats(row, 'orchestration_overhead')}
+    for row in plugin_rows:
+        report['plugins'].append({'plugin': row['_id'],
+                                  'count': row['count'],
+                                  'queue_wait': _duration_stats(row, 'queue_wait'),
+                                  'run_time': _duration_stats(row, 'run_time')})
+    return jsonify(success=True, report=report)
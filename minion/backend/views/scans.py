@@ -3,14 +3,15 @@
 import calendar
 import datetime
 import functools
-import uuid
 from flask import jsonify, request
 
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
+from minion.backend import budgets, leases, retries, scheduler, templates
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, plans, plugins, scans, sanitize_session, users, sites
+from minion.backend.views.base import api_guard, backend_config, groups, plans, plugins, scans, scan_leases, sanitize_session, users, sites
 from minion.backend.views.plans import sanitize_plan
+from minion.backend.views.users import _find_sites_for_user
 
 
 
@@ -43,6 +44,10 @@ def sanitize_scan(scan):
     for field in ('created', 'queued', 'started', 'finished'):
         if scan.get(field) is not None:
             scan[field] = calendar.timegm(scan[field].utctimetuple())
+    if scan.get('meta', {}).get('dispatched') is not None:
+        scan['meta']['dispatched'] = calendar.timegm(scan['meta']['dispatched'].utctimetuple())
+    if scan.get('meta', {}).get('lease') is not None:
+        scan['meta']['lease']['expires'] = calendar.timegm(scan['meta']['lease']['expires'].utctimetuple())
     if 'sessions' in scan:
         for session in scan['sessions']:
             sanitize_session(session)
@@ -104,6 +109,163 @@ def get_scan_summary(scan_id):
         return jsonify(success=False, reason='not-found')
     return jsonify(success=True, summary=summarize_scan(sanitize_scan(scan)))
 
+#
+# Return the timeline of a scan. Breaks the time the scan took down into
+# the time spent waiting in queues, the time plugins spent running and the
+# overhead of the orchestration in between. All durations are in seconds
+# and are null when the scan or session has not reached that point yet.
+#
+#  GET /scans/<scan_id>/timeline
+#
+#  { "success": true,
+#    "timeline": { "id": "...",
+#                  "state": "FINISHED",
+#                  "queue_wait": 3.1,
+#                  "run_time": 42.0,
+#                  "orchestration_overhead": 1.2,
+#                  "sessions": [ { "id": "...",
+#                                  "plugin": "minion.plugins.basic.AlivePlugin",
+#                                  "state": "FINISHED",
+#                                  "queue_wait": 0.2,
+#                                  "run_time": 2.3 }, ... ] } }
+#
+
+TIMELINE_FIELDS = { 'id': 1, 'state': 1, 'queued': 1, 'started': 1, 'finished': 1,
+                    'sessions.id': 1, 'sessions.plugin.class': 1, 'sessions.state': 1,
+                    'sessions.queued': 1, 'sessions.started': 1, 'sessions.finished': 1 }
+
+def _seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+def scan_timeline(scan):
+    timeline = { 'id': scan['id'],
+                 'state': scan['state'],
+                 'queue_wait': _seconds_between(scan.get('queued'), scan.get('started')),
+                 'run_time': _seconds_between(scan.get('started'), scan.get('finished')),
+                 'orchestration_overhead': None,
+                 'sessions': [] }
+    session_time = 0.0
+    for session in scan['sessions']:
+        queue_wait = _seconds_between(session.get('queued'), session.get('started'))
+        run_time = _seconds_between(session.get('started'), session.get('finished'))
+        session_time += (queue_wait or 0.0) + (run_time or 0.0)
+        timeline['sessions'].append({ 'id': session['id'],
+                                      'plugin': session['plugin']['class'],
+                                      'state': session['state'],
+                                      'queue_wait': queue_wait,
+                                      'run_time': run_time })
+    if timeline['run_time'] is not None:
+        timeline['orchestration_overhead'] = max(timeline['run_time'] - session_time, 0.0)
+    return timeline
+
+@app.route("/scans/<scan_id>/timeline")
+@api_guard
+@permission
+def get_scan_timeline(scan_id):
+    scan = scans.find_one({"id": scan_id}, TIMELINE_FIELDS)
+    if not scan:
+        return jsonify(success=False, reason='not-found')
+    return jsonify(success=True, timeline=scan_timeline(scan))
+
+#
+# Return the summaries of many scans in one request. The scan ids are
+# passed either as a JSON body or as repeated id parameters:
+#
+#  POST /scans/summaries
+#
+#  { "ids": ["b263bdc6-8692-4ace-aa8b-922b9ec0fc37", ...] }
+#
+#  GET /scans/summaries?id=b263bdc6-...&id=...
+#
+# Returns the summaries in the requested order. Scans that do not exist
+# or that the user is not allowed to see are listed in not_found:
+#
+#  { "success": true,
+#    "summaries": [ { "id": "b263bdc6-...", ... } ],
+#    "not_found": [ ... ] }
+#
+
+MAX_SUMMARIES = backend_config['api'].get('max_summaries', 100)
+
+SCHEDULER_CONFIG = scheduler.scheduler_config(backend_config)
+
+leases.ensure_indexes(scan_leases)
+
+def _acquire_lease(scan):
+    return leases.acquire(scan_leases, scans, scan)
+
+def _dispatch():
+    """ Dispatch pending scans, one per target and plan at a time unless
+    duplicates are allowed. """
+    acquire = None if SCHEDULER_CONFIG['duplicates'] == 'allow' else _acquire_lease
+    scheduler.dispatch(scans, SCHEDULER_CONFIG, acquire=acquire)
+
+def _over_capacity(count=1):
+    """ Return a 503 response that tells the client when to try again
+    if the backlog of pending scans is full, otherwise None. """
+    if scheduler.admit(scans, SCHEDULER_CONFIG, count):
+        return None
+    response = jsonify(success=False, reason='too-many-pending-scans',
+                       retry_after=SCHEDULER_CONFIG['retry_after'])
+    response.status_code = 503
+    response.headers['Retry-After'] = str(SCHEDULER_CONFIG['retry_after'])
+    return response
+
+SUMMARY_FIELDS = { 'id': 1, 'meta': 1, 'state': 1, 'configuration': 1, 'plan': 1,
+                   'created': 1, 'queued': 1, 'finished': 1,
+                   'sessions.id': 1, 'sessions.plugin': 1, 'sessions.state': 1,
+                   'sessions.issues.Severity': 1 }
+
+def _targets_for_email(email):
+    """ Return the list of targets the user can see, None if the user
+    can see all scans or False if the user does not exist. """
+    if not email or email == 'cron':
+        return None
+    user = users.find_one({'email': email})
+    if not user:
+        return False
+    if user['role'] != 'user':
+        return None
+    return _find_sites_for_user(email)
+
+@app.route("/scans/summaries", methods=["GET", "POST"])
+@api_guard
+def get_scan_summaries():
+    if request.method == 'POST':
+        scan_ids = (request.json or {}).get('ids', [])
+    else:
+        scan_ids = request.args.getlist('id')
+    if not isinstance(scan_ids, list) or not all(isinstance(i, basestring) for i in scan_ids):
+        return jsonify(success=False, reason='invalid-scan-ids')
+    if len(scan_ids) > MAX_SUMMARIES:
+        return jsonify(success=False, reason='too-many-scans')
+    targets = _targets_for_email(request.args.get('email'))
+    if targets is False:
+        return jsonify(success=False, reason='user-does-not-exist')
+    query = {'id': {'$in': scan_ids}}
+    if targets is not None:
+        query['configuration.target'] = {'$in': targets}
+    found = {}
+    for scan in scans.find(query, SUMMARY_FIELDS):
+        found[scan['id']] = summarize_scan(sanitize_scan(scan))
+    return jsonify(success=True,
+                   summaries=[found[i] for i in scan_ids if i in found],
+                   not_found=[i for i in scan_ids if i not in found])
+
+def _build_scan(plan, configuration, user, priority, budget=None):
+    """ Create a scan object with a session for each step in the plan,
+    from the compiled template of the plan. """
+    return templates.template_for(plan, plugins).new_scan(configuration, user, priority, budget)
+
+def _queue_scan(scan):
+    """ Move a scan that has not been saved yet straight to QUEUED. """
+    scan['state'] = 'QUEUED'
+    scan['queued'] = datetime.datetime.utcnow()
+    scan['meta']['tenant'] = scheduler.tenant_for_scan(scan, groups, SCHEDULER_CONFIG)
+    scan['meta']['dispatched'] = None
+
 #
 # Create a scan by POSTING a configuration to the /scan
 # resource. The configuration looks like this:
@@ -112,9 +274,16 @@ def get_scan_summary(scan_id):
 #      "plan": "tickle",
 #      "configuration": {
 #        "target": "http://foo"
-#      }
+#      },
+#      "priority": "interactive",
+#      "budget": 3600
 #   }
 #
+# The priority is optional and is either "interactive" or "batch". It
+# defaults to batch for scheduled scans and to interactive otherwise. The
+# budget is optional too, it limits the run time of the scan in seconds.
+# See minion.backend.budgets.
+#
 
 @app.route("/scans", methods=["POST"])
 @api_guard('application/json')
@@ -126,38 +295,133 @@ def post_scan_create():
     plan = plans.find_one({"name": configuration['plan']})
     if not plan:
         return jsonify(success=False)
-    # Merge the configuration
-    # Create a scan object
-    now = datetime.datetime.utcnow()
-    scan = { "id": str(uuid.uuid4()),
-             "state": "CREATED",
-             "created": now,
-             "queued": None,
-             "started": None,
-             "finished": None,
-             "plan": { "name": plan['name'], "revision": 0 },
-             "configuration": configuration['configuration'],
-             "sessions": [],
-             "meta": { "user": configuration['user'], "tags": [] } }
-    for step in plan['workflow']:
-        session_configuration = step['configuration']
-        session_configuration.update(configuration['configuration'])
-        session = { "id": str(uuid.uuid4()),
-                    "state": "CREATED",
-                    "plugin": plugins[step['plugin_name']]['descriptor'],
-                    "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
-                    "description": step["description"],
-                    "artifacts": {},
-                    "issues": [],
-                    "created": now,
-                    "queued": None,
-                    "started": None,
-                    "finished": None,
-                    "progress": None }
-        scan['sessions'].append(session)
+    # Batch or interactive, see minion.backend.scheduler
+    priority = configuration.get('priority')
+    if priority is not None and priority not in scheduler.PRIORITIES:
+        return jsonify(success=False, reason='invalid-priority')
+    # Time budget in seconds, overrides the one of the plan
+    if not budgets.valid_budget(configuration.get('budget')):
+        return jsonify(success=False, reason='invalid-budget')
+    # Push back on large imports while the backlog is full
+    refused = _over_capacity()
+    if refused is not None:
+        return refused
+    scan = _build_scan(plan, configuration['configuration'], configuration['user'],
+                       scheduler.scan_priority(configuration['user'], priority, SCHEDULER_CONFIG),
+                       configuration.get('budget'))
     scans.insert(scan)
     return jsonify(success=True, scan=sanitize_scan(scan))
 
+#
+# Create, and optionally start, many scans in one request:
+#
+#  POST /scans/batch?email=bob@example.org
+#
+#  { "user": "bob@example.org",
+#    "start": true,
+#    "scans": [ { "plan": "basic", "target": "http://foo" },
+#               { "plan": "basic", "configuration": { "target": "http://bar" } } ] }
+#
+# Every plan is loaded once, all scans are inserted with a single write
+# and, when start is true, queued together. The results are in the order
+# of the request:
+#
+#  { "success": true,
+#    "results": [ { "success": true, "scan": { "id": "...", ... } },
+#                 { "success": false, "reason": "no-such-plan" } ] }
+#
+# Started scans follow scheduler.duplicates like START does. A scan whose
+# target and plan are already in flight is not created, its result is
+# { "success": false, "reason": "duplicate-scan", "scan_id": "..." } with
+# reject and { "success": true, "attached": "..." } with attach.
+#
+
+MAX_BATCH = backend_config['api'].get('max_batch', 100)
+
+@app.route("/scans/batch", methods=["POST"])
+@api_guard('application/json')
+def post_scan_batch():
+    batch = request.json or {}
+    items = batch.get('scans')
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify(success=False, reason='invalid-scans')
+    if len(items) > MAX_BATCH:
+        return jsonify(success=False, reason='too-many-scans')
+    user = batch.get('user')
+    if not user:
+        return jsonify(success=False, reason='no-user')
+    priority = batch.get('priority')
+    if priority is not None and priority not in scheduler.PRIORITIES:
+        return jsonify(success=False, reason='invalid-priority')
+    targets = _targets_for_email(request.args.get('email'))
+    if targets is False:
+        return jsonify(success=False, reason='user-does-not-exist')
+    start = batch.get('start')
+    priority = scheduler.scan_priority(user, priority, SCHEDULER_CONFIG)
+    plan_names = list(set(item.get('plan') for item in items))
+    planz = dict((plan['name'], plan) for plan in plans.find({'name': {'$in': plan_names}}))
+    results, valid = [], []
+    for item in items:
+        if not isinstance(item.get('configuration', {}), dict):
+            results.append({'success': False, 'reason': 'invalid-configuration'})
+            continue
+        configuration = dict(item.get('configuration') or {})
+        if item.get('target'):
+            configuration['target'] = item['target']
+        if item.get('plan') not in planz:
+            results.append({'success': False, 'reason': 'no-such-plan'})
+        elif not configuration.get('target'):
+            results.append({'success': False, 'reason': 'no-target'})
+        elif targets is not None and configuration['target'] not in targets:
+            results.append({'success': False, 'reason': 'not-found'})
+        else:
+            result = {'success': True}
+            results.append(result)
+            valid.append((result, planz[item['plan']], configuration))
+    # Only started scans add to the backlog of pending scans
+    if start and valid:
+        refused = _over_capacity(len(valid))
+        if refused is not None:
+            return refused
+    new_scans, holders = [], {}
+    for result, plan, configuration in valid:
+        scan = _build_scan(plan, configuration, user, priority)
+        if start:
+            holder = _admit_batch_scan(scan, holders)
+            if holder is not None:
+                if SCHEDULER_CONFIG['duplicates'] == 'reject':
+                    result.update(success=False, reason='duplicate-scan', scan_id=holder)
+                else:
+                    result['attached'] = holder
+                continue
+            _queue_scan(scan)
+        new_scans.append(scan)
+        result['scan'] = scan
+    if new_scans:
+        scans.insert(new_scans)
+        if start:
+            _dispatch()
+    for result in results:
+        if 'scan' in result:
+            result['scan'] = summarize_scan(sanitize_scan(result['scan']))
+    return jsonify(success=True, results=results)
+
+def _admit_batch_scan(scan, holders):
+    """ Return the id of the scan in flight for the same target and plan
+    if a scan of a batch may not be queued, otherwise None. holders has
+    the leases taken earlier in the batch, for scans not saved yet. With
+    the queue policy duplicates wait for the lease in the scheduler. """
+    if SCHEDULER_CONFIG['duplicates'] not in ('reject', 'attach'):
+        return None
+    key = (scan['configuration']['target'], scan['plan']['name'])
+    holder = holders.get(key)
+    if holder is None:
+        holder = _acquire_lease(scan)
+        if holder == scan['id']:
+            holders[key] = holder
+    if holder is not None and holder != scan['id']:
+        return holder
+
 @app.route("/scans", methods=["GET"])
 @permission
 def get_scans():
@@ -170,6 +434,35 @@ def get_scans():
                         "configuration.target": site['url']}).sort("created", -1).limit(limit)
     return jsonify(success=True, scans=[summarize_scan(sanitize_scan(s)) for s in scanz])
 
+def _admit_scan(scan):
+    """ Return the response for a scan that cannot be queued now because
+    the backlog is full or the same target and plan is in flight,
+    otherwise None. """
+    refused = _over_capacity()
+    if refused is not None:
+        return refused
+    # Only one scan per target and plan is in flight at a time
+    policy = SCHEDULER_CONFIG['duplicates']
+    if policy != 'allow':
+        holder = _acquire_lease(scan)
+        if holder is not None and holder != scan['id']:
+            if policy == 'reject':
+                return jsonify(success=False, reason='duplicate-scan', scan_id=holder)
+            if policy == 'attach':
+                return jsonify(success=True, attached=holder)
+
+#
+# Control a scan:
+#
+#  PUT /scans/<scan_id>/control
+#
+# With START, STOP or RERUN_FAILED as the body. RERUN_FAILED queues a scan
+# that has ended again to run only its sessions that did not finish, see
+# minion.backend.retries.
+#
+
+ENDED_STATES = ('FINISHED', 'FAILED', 'STOPPED', 'ABORTED', 'TIMEOUT')
+
 @app.route("/scans/<scan_id>/control", methods=["PUT"])
 @api_guard
 @permission
@@ -180,18 +473,85 @@ def put_scan_control(scan_id):
         return jsonify(success=False, error='no-such-scan')
     # Check if the state is valid
     state = request.data
-    if state not in ('START', 'STOP'):
+    if state not in ('START', 'STOP', 'RERUN_FAILED'):
         return jsonify(success=False, error='unknown-state')
     # Handle start
     if state == 'START':
         if scan['state'] != 'CREATED':
             return jsonify(success=False, error='invalid-state-transition')
-        # Queue the scan to start
-        scans.update({"id": scan_id}, {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow()}})
-        tasks.scan.apply_async([scan['id']], countdown=3, queue='scan')
+        refused = _admit_scan(scan)
+        if refused is not None:
+            return refused
+        # Queue the scan. The scheduler sends it to the scan queue when
+        # its tenant has capacity left.
+        scans.update({"id": scan_id}, {"$set": {"state": "QUEUED",
+                                                "queued": datetime.datetime.utcnow(),
+                                                "meta.tenant": scheduler.tenant_for_scan(scan, groups, SCHEDULER_CONFIG),
+                                                "meta.dispatched": None}})
+        _dispatch()
+    # Handle rerun of the sessions that did not finish
+    if state == 'RERUN_FAILED':
+        if scan['state'] not in ENDED_STATES:
+            return jsonify(success=False, error='invalid-state-transition')
+        sessions, count = retries.rerun_sessions(scan['sessions'])
+        if count == 0:
+            return jsonify(success=False, error='nothing-to-rerun')
+        refused = _admit_scan(scan)
+        if refused is not None:
+            return refused
+        tenant = scheduler.tenant_for_scan(scan, groups, SCHEDULER_CONFIG)
+        if not retries.rerun_scan(scans, scan, sessions, tenant):
+            return jsonify(success=False, error='invalid-state-transition')
+        _dispatch()
+        return jsonify(success=True, sessions=count)
     # Handle stop
     if state == 'STOP':
         scans.update({"id": scan_id}, {"$set": {"state": "STOPPING", "queued": datetime.datetime.utcnow()}})
         tasks.scan_stop.apply_async([scan['id']], queue='state')
     return jsonify(success=True)
 
+
+#
+# Return just the state of a scan and its sessions. Scan and plugin workers
+# poll this to notice quickly that a scan is being stopped.
+#
+#  GET /scans/<scan_id>/control
+#
+#  { "success": true,
+#    "state": "STOPPING",
+#    "sessions": [ { "id": "...", "state": "STARTED" }, ... ] }
+#
+
+@app.route("/scans/<scan_id>/control", methods=["GET"])
+@api_guard
+@permission
+def get_scan_control(scan_id):
+    scan = scans.find_one({"id": scan_id}, {"state": 1, "sessions.id": 1, "sessions.state": 1})
+    if not scan:
+        return jsonify(success=False, reason='not-found')
+    return jsonify(success=True, state=scan['state'], sessions=scan['sessions'])
+
+#
+# Return how the running scans are shared between tenants:
+#
+#  GET /scans/shares
+#
+#  { "success": true,
+#    "running": 12,
+#    "max_running": 50,
+#    "pending": 3,
+#    "max_pending": 1000,
+#    "shares": [ { "tenant": "security", "running": 8, "pending": 0,
+#                  "cap": 10, "weight": 2.0, "share": 0.67 }, ... ] }
+#
+
+@app.route("/scans/shares", methods=["GET"])
+@api_guard
+def get_scan_shares():
+    shares = scheduler.share_usage(scans, SCHEDULER_CONFIG)
+    return jsonify(success=True,
+                   running=sum(share['running'] for share in shares),
+                   max_running=SCHEDULER_CONFIG['max_running'],
+                   pending=sum(share['pending'] for share in shares),
+                   max_pending=SCHEDULER_CONFIG['max_pending'],
+                   shares=shares)
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import signal
+import socket
+import time
+
+#
+# The plugin worker watches its plugin runner for hangs. It is configured
+# in the 'plugin_worker' section of backend.json:
+#
+#   "plugin_worker": { "inactivity_timeout": 600,
+#                      "max_runtime": 7200,
+#                      "kill_grace": 10 }
+#
+# Both limits are off by default. A session stopped by the watchdog ends
+# as TERMINATED with the reason in its failure, whatever the plugin
+# reported on its way out.
+#
+
+class Watchdog:
+
+    """
+    Watches a plugin runner for hangs. A plugin that has not written any
+    output for inactivity_timeout seconds, or that has been running for
+    max_runtime seconds, is asked to stop with SIGUSR1. If it is still
+    around grace seconds later it gets a SIGTERM and after another grace
+    period a SIGKILL. Either limit can be None to disable it.
+    """
+
+    SIGNALS = (signal.SIGUSR1, signal.SIGTERM, signal.SIGKILL)
+
+    def __init__(self, inactivity_timeout, max_runtime, grace, now=None):
+        now = now if now is not None else time.time()
+        self.inactivity_timeout = inactivity_timeout
+        self.max_runtime = max_runtime
+        self.grace = grace
+        self.reason = None
+        self._started = now
+        self._last_activity = now
+        self._level = None
+        self._escalated = None
+
+    @property
+    def triggered(self):
+        return self.reason is not None
+
+    def activity(self, now=None):
+        self._last_activity = now if now is not None else time.time()
+
+    def check(self, now=None):
+        """ Return the signal to send to the plugin runner now, if any. """
+        now = now if now is not None else time.time()
+        if self.reason is None:
+            if self.max_runtime is not None and now - self._started >= self.max_runtime:
+                self.reason = 'plugin-max-runtime-exceeded'
+            elif self.inactivity_timeout is not None and now - self._last_activity >= self.inactivity_timeout:
+                self.reason = 'plugin-inactive'
+            else:
+                return None
+            self._level, self._escalated = 0, now
+            return self.SIGNALS[0]
+        if self._level < len(self.SIGNALS) - 1 and now - self._escalated >= self.grace:
+            self._level, self._escalated = self._level + 1, now
+            return self.SIGNALS[self._level]
+
+def watchdog_config(cfg):
+    config = cfg.get('plugin_worker', {})
+    return (config.get('inactivity_timeout'), config.get('max_runtime'), config.get('kill_grace', 10))
+
+def watchdog_failure(watchdog, reported):
+    """ Return the failure to finish the session as TERMINATED with, or None
+    if the watchdog left the plugin alone or the session already ended. """
+    if watchdog.triggered and not reported:
+        return { "hostname": socket.gethostname(),
+                 "reason": watchdog.reason,
+                 "message": "The plugin was terminated by the watchdog",
+                 "exception": None }
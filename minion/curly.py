@@ -8,6 +8,8 @@ import urlparse
 
 import pycurl
 
+from minion.ratelimit import wait_for_host
+
 CURL_ERRORS = {
     'default': 
         {
@@ -90,6 +92,7 @@ class Response:
             raise BadResponseError(status_code=self.status)
 
 def _get(c, url, headers={}, connect_timeout=None, timeout=None):
+    wait_for_host(urlparse.urlparse(url).hostname)
     http_response = HTTPResponse(url)
     c.setopt(c.WRITEFUNCTION, http_response._body_callback)
     c.setopt(c.HEADERFUNCTION, http_response._header_callback)
@@ -15,6 +15,8 @@ from twisted.internet.error import ProcessDone, ProcessTerminated
 from twisted.internet.protocol import ProcessProtocol
 import zope.interface
 
+from minion.ratelimit import delay_for_host
+
 
 class IPluginRunnerCallbacks(zope.interface.Interface):
 
@@ -252,6 +254,8 @@ class ExternalProcessPlugin(AbstractPlugin):
 
     def __init__(self):
         self.stopping = False
+        self.process = None
+        self._spawn_call = None
 
     def locate_program(self, program_name):
         for path in os.getenv('PATH').split(os.pathsep):
@@ -260,6 +264,15 @@ class ExternalProcessPlugin(AbstractPlugin):
                 return program_path
 
     def spawn(self, path, arguments):
+        # The tool does its own requests, so one token is taken per launch.
+        # Without one, try again later without blocking the reactor.
+        self._spawn_call = None
+        target = self.configuration.get('target')
+        if target:
+            wait = delay_for_host(urlparse.urlparse(target).hostname)
+            if wait > 0:
+                self._spawn_call = reactor.callLater(wait, self.spawn, path, arguments)
+                return
         protocol = ExternalProcessProtocol(self)
         name = path.split('/')[-1]
         logging.debug("Executing %s %s" % (path, " ".join([name] + arguments)))
@@ -281,4 +294,10 @@ class ExternalProcessPlugin(AbstractPlugin):
     def do_stop(self):
         logging.debug("ExternalProcessPlugin.do_stop")
         self.stopping = True
+        if getattr(self, 'process', None) is None:
+            # Still waiting for the rate limit, the tool never ran
+            if getattr(self, '_spawn_call', None) is not None and self._spawn_call.active():
+                self._spawn_call.cancel()
+            self.report_finish(AbstractPlugin.EXIT_STATE_STOPPED)
+            return
         self.process.signalProcess('KILL')
@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+#
+# Per target host rate limiting, shared by all plugin workers so that many
+# plugin sessions against the same host do not overload it.
+#
+# The limiter is a token bucket implemented as GCRA (generic cell rate
+# algorithm): for every host the store keeps a single timestamp, the
+# theoretical arrival time of the next request. A request is allowed when
+# that time is not more than burst / rate seconds in the future. Updates are
+# done with compare-and-set so that the limit holds across processes.
+#
+# It is configured in the 'ratelimit' section of backend.json:
+#
+#   "ratelimit": { "enabled": true,
+#                  "rate": 5,          # requests per second per host
+#                  "burst": 10,        # requests that may be done at once
+#                  "store": "mongodb" }
+#
+# The mongodb store needs the 'mongodb' section. Without it (or with
+# "store": "memory") the limit only applies within a single process.
+#
+
+DEFAULT_RATELIMIT_CONFIG = {
+    'enabled': False,
+    'rate': 5,
+    'burst': 10,
+    'store': 'mongodb'
+}
+
+def ratelimit_config(cfg):
+    config = dict(DEFAULT_RATELIMIT_CONFIG)
+    config.update(cfg.get('ratelimit', {}))
+    return config
+
+class MemoryStore:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def compare_and_set(self, key, old, new):
+        with self._lock:
+            if self._values.get(key) != old:
+                return False
+            self._values[key] = new
+            return True
+
+class MongoStore:
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.ensure_index('host', unique=True)
+
+    def get(self, key):
+        doc = self.collection.find_one({'host': key})
+        if doc is not None:
+            return doc['tat']
+
+    def compare_and_set(self, key, old, new):
+        if old is None:
+            try:
+                self.collection.insert({'host': key, 'tat': new})
+                return True
+            except DuplicateKeyError:
+                # Somebody else created the bucket first
+                return False
+        result = self.collection.update({'host': key, 'tat': old}, {'$set': {'tat': new}})
+        return result is not None and result.get('n') == 1
+
+class RateLimiter:
+
+    def __init__(self, store, rate, burst, clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+        self._clock = clock
+        self._sleep = sleep
+
+    def try_acquire(self, host):
+        """ Take a token for the host. Returns 0 when the request may be
+        done now or the number of seconds to wait before trying again. """
+        now = self._clock()
+        tat = self.store.get(host)
+        new_tat = max(tat or now, now) + self.interval
+        wait = new_tat - now - self.tolerance
+        if wait > 0:
+            return wait
+        if not self.store.compare_and_set(host, tat, new_tat):
+            return 0.01 # Lost a race with another worker, try again right away
+        return 0
+
+    def acquire(self, host):
+        """ Block until a request to the host is allowed. """
+        while True:
+            wait = self.try_acquire(host)
+            if wait == 0:
+                return
+            self._sleep(wait)
+
+limiter = None
+limiter_configured = False
+
+def get_limiter():
+    """ Return the process wide limiter or None if rate limiting is not enabled. """
+    global limiter, limiter_configured
+    if not limiter_configured:
+        limiter_configured = True
+        from minion.backend.utils import backend_config
+        cfg = backend_config()
+        config = ratelimit_config(cfg)
+        if config['enabled']:
+            if config['store'] == 'mongodb' and cfg.get('mongodb') is not None:
+                from pymongo import MongoClient
+                client = MongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
+                store = MongoStore(client.minion.ratelimit)
+            else:
+                logging.warning("Rate limiting per process only, there is no shared store")
+                store = MemoryStore()
+            limiter = RateLimiter(store, config['rate'], config['burst'])
+    return limiter
+
+def delay_for_host(host):
+    """ Take a token for the host if the rate limit allows a request now.
+    Returns 0 if it did, otherwise the seconds to wait before asking again.
+    Never blocks, for use from the twisted reactor. """
+    l = get_limiter()
+    if l is not None and host:
+        return l.try_acquire(host.lower())
+    return 0
+
+def wait_for_host(host):
+    """ Block until the rate limit allows a request to the host. Does
+    nothing when rate limiting is disabled. """
+    l = get_limiter()
+    if l is not None and host:
+        l.acquire(host.lower())
@@ -44,6 +44,7 @@ setup(name="minion-backend",
                'scripts/minion-plugin-worker',
                'scripts/minion-scan',
                'scripts/minion-state-worker',
+               'scripts/minion-callback-worker',
                'scripts/minion-scan-worker',
                'scripts/minion-plugin-runner',
                'scripts/minion-scanschedule-worker',
@@ -147,6 +147,19 @@ class Group(Resource):
     def delete(self):
         return self.session.delete(self.api + "/" + self.group_name)
 
+    def create_campaign(self, plan_name, user, max_concurrency=None):
+        data = {"plan": plan_name, "user": user}
+        if max_concurrency is not None:
+            data["max_concurrency"] = max_concurrency
+        return self.session.post(self.api + "/" + self.group_name + "/campaigns",
+            data=json.dumps(data), headers=self.json_header)
+
+    def get_campaigns(self):
+        return self.session.get(self.api + "/" + self.group_name + "/campaigns")
+
+    def get_campaign(self, campaign_id):
+        return self.session.get(self.api + "/" + self.group_name + "/campaigns/" + campaign_id)
+
 class Sites(Resource):
     def __init__(self):
         super(Sites, self).__init__()
@@ -282,6 +295,19 @@ class Scans(Resource):
             params["site_id"] = site_id
         return self.session.get(self.api, params=params)
 
+    def get_summaries(self, ids, email=None):
+        return self.session.post(self.api + "/summaries",
+            data=json.dumps({"ids": ids}), params={"email": email},
+            headers=self.json_header)
+
+    def create_batch(self, user, items, start=False, email=None):
+        return self.session.post(self.api + "/batch",
+            data=json.dumps({"user": user, "scans": items, "start": start}),
+            params={"email": email}, headers=self.json_header)
+
+    def get_shares(self):
+        return self.session.get(self.api + "/shares")
+
 class Scan(Resource):
     def __init__(self, email, plan_name, configuration):
         super(Scan, self).__init__()
@@ -307,12 +333,23 @@ class Scan(Resource):
         return self.session.get(self.api + "/" + scan_id + "/summary",
             params={"email": email})
 
+    def get_timeline(self, scan_id, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/timeline",
+            params={"email": email})
+
     def start(self, scan_id, email=None):
         return self._update(scan_id, "START", email=email)
 
     def stop(self, scan_id, email=None):
         return self._update(scan_id, "STOP", email=email)
 
+    def rerun_failed(self, scan_id, email=None):
+        return self._update(scan_id, "RERUN_FAILED", email=email)
+
+    def get_control(self, scan_id, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/control",
+            params={"email": email})
+
     def _update(self, scan_id, state, email=None):
         return self.session.put(self.api + "/" + scan_id + "/control",
             data=state, params={"email": email})
@@ -352,6 +389,14 @@ class Reports(Resource):
                 params["group_name"] = group_name
         return self.session.get(self.api + "/issues", params=params)
 
+    def get_timeline(self, plan_name=None, since=None):
+        params = {}
+        if plan_name is not None:
+            params["plan_name"] = plan_name
+        if since is not None:
+            params["since"] = since
+        return self.session.get(self.api + "/timeline", params=params)
+
 class TestAPIBaseClass(unittest.TestCase):
     def setUp(self):
         self.mongodb = MongoClient()
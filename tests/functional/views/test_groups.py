@@ -126,6 +126,37 @@ class TestGroupAPIs(TestAPIBaseClass):
         self.assertEqual(len(r), 1) # there should just be one dict returned in the list
         self.assertEqual(r[0]['target'], site1.url)
 
+    def test_create_campaign(self):
+        bob = User(self.email)
+        bob.create()
+        group = Group(self.group_name, users=[bob.email])
+        group.create()
+        plan = Plan(self.TEST_PLAN)
+        plan.create()
+        for url in ("http://foo.com", "http://bar.com", "http://baz.com"):
+            Site(url, groups=[group.group_name]).create()
+
+        res = group.create_campaign(self.TEST_PLAN["name"], bob.email, max_concurrency=2)
+        self.assertEqual(res.json()["success"], True)
+        campaign = res.json()["campaign"]
+        self.assertEqual(campaign["state"], "RUNNING")
+        self.assertEqual(campaign["total"], 3)
+        self.assertEqual(campaign["waiting"], 1)
+        self.assertEqual(len(campaign["scans"]), 3)
+
+        res = group.get_campaign(campaign["id"])
+        self.assertEqual(res.json()["campaign"]["id"], campaign["id"])
+        res = group.get_campaigns()
+        self.assertEqual([c["id"] for c in res.json()["campaigns"]], [campaign["id"]])
+        self.assertFalse("scans" in res.json()["campaigns"][0])
+
+    def test_create_campaign_for_unknown_plan(self):
+        group = Group(self.group_name)
+        group.create()
+        res = group.create_campaign("nonexistent", self.email)
+        self.assertEqual(res.json()["success"], False)
+        self.assertEqual(res.json()["reason"], "no-such-plan")
+
     def test_delete_group(self):
         group = Group(self.group_name)
         group.create()
@@ -147,3 +147,10 @@ class TestPlanAPIs(TestAPIBaseClass):
         _res2_plan = {key:value for key,value in res2.json()["plan"].items() 
                 if key in ("name", "description", "workflow")}
         self.assertEqual(_res2_plan, _new_plan)
+
+    def test_update_plan_bumps_revision(self):
+        plan = Plan(self.TEST_PLAN)
+        res = plan.create()
+        self.assertEqual(res.json()["plan"]["revision"], 1)
+        res = plan.update(plan.plan["name"], {"workflow": self.TEST_PLAN["workflow"]})
+        self.assertEqual(res.json()["plan"]["revision"], 2)
@@ -48,6 +48,8 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual(meta['tags'], [])
         # bug #106 add owner of the scan
         self.assertEqual(meta['user'], self.user.email)
+        # scans started by a person are interactive
+        self.assertEqual(meta['priority'], 'interactive')
         self.assertEqual(res.json()['scan']['configuration']['target'],
             self.target_url)
 
@@ -105,6 +107,117 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual(res2.json()["success"], False)
         self.assertEqual(res2.json()["reason"], "not-found")
 
+    def test_get_scan_summaries(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_ids = [scan.create().json()['scan']['id'] for i in range(3)]
+
+        res = Scans().get_summaries(scan_ids + ['nonexistent'], email=self.user.email)
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual([s['id'] for s in res.json()['summaries']], scan_ids)
+        self.assertEqual(res.json()['not_found'], ['nonexistent'])
+        for summary in res.json()['summaries']:
+            self.assertEqual(summary['state'], 'CREATED')
+            self.assertEqual(summary['issues'], {'high': 0, 'medium': 0, 'low': 0, 'info': 0})
+
+        # Alice is not in Bob's group so she cannot see his scans
+        alice = User("alice@example.org")
+        alice.create()
+        res = Scans().get_summaries(scan_ids, email=alice.email)
+        self.assertEqual(res.json()['summaries'], [])
+        self.assertEqual(res.json()['not_found'], scan_ids)
+
+    def test_get_scan_timeline_of_new_scan(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        res = scan.get_timeline(scan_id, email=self.user.email)
+        self.assertEqual(res.json()["success"], True)
+        timeline = res.json()["timeline"]
+        self.assertEqual(timeline["state"], "CREATED")
+        for name in ('queue_wait', 'run_time', 'orchestration_overhead'):
+            self.assertEqual(timeline[name], None)
+        self.assertEqual(len(timeline["sessions"]), 1)
+        self.assertEqual(timeline["sessions"][0]["plugin"], "minion.plugins.test.HelloWorldPlugin")
+
+    def test_get_reports_timeline_with_invalid_since(self):
+        res = Reports().get_timeline(since="yesterday")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()["success"], False)
+        self.assertEqual(res.json()["reason"], "invalid-since")
+
+    def test_create_scan_batch(self):
+        items = [{"plan": self.TEST_PLAN["name"], "target": self.target_url},
+                 {"plan": self.TEST_PLAN["name"], "configuration": {"target": self.target_url}},
+                 {"plan": "nonexistent", "target": self.target_url}]
+        res = Scans().create_batch(self.user.email, items, email=self.user.email)
+        self.assertEqual(res.json()["success"], True)
+        results = res.json()["results"]
+        self.assertEqual([r["success"] for r in results], [True, True, False])
+        self.assertEqual(results[2]["reason"], "no-such-plan")
+        scan_ids = [r["scan"]["id"] for r in results[:2]]
+        self.assertNotEqual(scan_ids[0], scan_ids[1])
+        for r in results[:2]:
+            self.assertEqual(r["scan"]["state"], "CREATED")
+            self.assertEqual(r["scan"]["configuration"]["target"], self.target_url)
+            self.assertEqual(len(r["scan"]["sessions"]), 1)
+
+        res = Scans().get_summaries(scan_ids, email=self.user.email)
+        self.assertEqual([s['id'] for s in res.json()['summaries']], scan_ids)
+
+    def test_create_scan_batch_with_invalid_configuration(self):
+        items = [{"plan": self.TEST_PLAN["name"], "configuration": "target=%s" % self.target_url},
+                 {"plan": self.TEST_PLAN["name"], "configuration": [self.target_url]},
+                 {"plan": self.TEST_PLAN["name"], "target": self.target_url}]
+        res = Scans().create_batch(self.user.email, items, email=self.user.email)
+        results = res.json()["results"]
+        self.assertEqual([r["success"] for r in results], [False, False, True])
+        self.assertEqual(results[0]["reason"], "invalid-configuration")
+        self.assertEqual(results[1]["reason"], "invalid-configuration")
+
+    def test_create_and_start_scan_batch(self):
+        items = [{"plan": self.TEST_PLAN["name"], "target": self.target_url}]
+        res = Scans().create_batch(self.user.email, items, start=True, email=self.user.email)
+        self.assertEqual(res.json()["results"][0]["scan"]["state"], "QUEUED")
+
+    def test_get_scan_shares(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        res = Scans().get_shares()
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual(res.json()["shares"], [])
+
+        scan.start(scan_id)
+        res = Scans().get_shares()
+        share = res.json()["shares"][0]
+        self.assertEqual(share["tenant"], self.user.email)
+        self.assertEqual(share["running"] + share["pending"], 1)
+
+    def test_get_scan_control(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        created = scan.create().json()['scan']
+        res = scan.get_control(created['id'])
+        self.assertEqual(res.json(), {'success': True, 'state': 'CREATED',
+                                      'sessions': [{'id': created['sessions'][0]['id'], 'state': 'CREATED'}]})
+
+        scan.start(created['id'])
+        scan.stop(created['id'])
+        res = scan.get_control(created['id'])
+        self.assertTrue(res.json()['state'] in ('STOPPING', 'STOPPED'))
+
+    def test_rerun_failed_sessions(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        res = scan.rerun_failed(scan_id)
+        self.assertEqual(res.json(), {'success': False, 'error': 'invalid-state-transition'})
+
+        scan.start(scan_id)
+        scan.stop(scan_id)
+        time.sleep(2)
+        self.assertEqual(scan.get_scan_details(scan_id).json()['scan']['state'], 'STOPPED')
+
+        res = scan.rerun_failed(scan_id)
+        self.assertEqual(res.json(), {'success': True, 'sessions': 1})
+        self.assertNotEqual(scan.get_scan_details(scan_id).json()['scan']['state'], 'STOPPED')
+
     def test_scan(self):
         """
         This is a comprehensive test that runs through the following
@@ -187,3 +300,15 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual('Info', issues[0]['severity'])
         self.assertEqual(issues[0]["severity"], "Info")
         self.assertEqual(res8.json()['report'][0]['target'], self.target_url)
+
+        # GET /scans/<scan_id>/timeline
+        res9 = scan.get_timeline(scan_id)
+        timeline = res9.json()['timeline']
+        self.assertEqual(timeline['state'], 'FINISHED')
+        self.assertTrue(timeline['queue_wait'] >= 0)
+        self.assertTrue(timeline['sessions'][0]['run_time'] >= 0)
+
+        # GET /reports/timeline
+        res10 = Reports().get_timeline(plan_name=self.plan.plan["name"])
+        self.assertEqual(res10.json()['report']['scans']['count'], 1)
+        self.assertEqual(res10.json()['report']['plugins'][0]['plugin'], "minion.plugins.test.HelloWorldPlugin")
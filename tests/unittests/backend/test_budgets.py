@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend.budgets import DEFAULT_BUDGET_CONFIG, Deadline, scan_budget, valid_budget
+
+
+class TestBudgets(unittest.TestCase):
+
+    def test_valid_budget(self):
+        for budget in (None, 1, 2.5, 3600):
+            self.assertTrue(valid_budget(budget))
+        for budget in (0, -1, "60", True, {}):
+            self.assertFalse(valid_budget(budget))
+
+    def test_scan_budget(self):
+        plan = {'budget': 3600,
+                'workflow': [{'plugin_name': 'a', 'budget': 600}, {'plugin_name': 'b'}]}
+        sessions = [{'id': 's1'}, {'id': 's2'}]
+        self.assertEqual(scan_budget(plan, sessions), {'scan': 3600, 'sessions': {'s1': 600}})
+        self.assertEqual(scan_budget(plan, sessions, 60)['scan'], 60)
+
+    def test_unlimited(self):
+        deadline = Deadline(None, DEFAULT_BUDGET_CONFIG, started=1000)
+        self.assertFalse(deadline.expired(now=10 ** 9))
+        self.assertEqual(deadline.session_timeout('s1', now=2000), None)
+
+    def test_session_timeout_is_bounded_by_the_scan(self):
+        deadline = Deadline({'scan': 100, 'sessions': {'s1': 60}}, DEFAULT_BUDGET_CONFIG, started=1000)
+        self.assertEqual(deadline.session_timeout('s1', now=1000), 60)
+        self.assertEqual(deadline.session_timeout('s1', now=1070), 30)
+        self.assertEqual(deadline.session_timeout('s2', now=1070), 30)
+        self.assertFalse(deadline.expired(now=1099))
+        self.assertTrue(deadline.expired(now=1100))
+        self.assertEqual(deadline.session_timeout('s2', now=1200), 0)
+
+    def test_config_defaults(self):
+        deadline = Deadline({'sessions': {}}, {'scan': 500, 'session': 50}, started=1000)
+        self.assertEqual(deadline.session_timeout('s1', now=1000), 50)
+        self.assertTrue(deadline.expired(now=1500))
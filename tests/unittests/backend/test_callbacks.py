@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend.callbacks import (acquire_slot, callback_config, callback_endpoint,
+                                      release_slot, retry_countdown)
+
+
+class FakeSlots:
+
+    """ A slots collection with a unique index on endpoint and slot. """
+
+    def __init__(self):
+        self.slots = {}
+
+    def find_and_modify(self, spec, update, upsert=False):
+        key = (spec['endpoint'], spec['slot'])
+        slot = self.slots.get(key)
+        if slot is not None and not slot['expires'] < spec['expires']['$lt']:
+            raise DuplicateKeyError("duplicate key")
+        self.slots[key] = dict(update['$set'])
+        return slot
+
+    def remove(self, spec):
+        key = (spec['endpoint'], spec['slot'])
+        if key in self.slots and self.slots[key]['holder'] == spec['holder']:
+            del self.slots[key]
+
+
+class TestCallbacks(unittest.TestCase):
+
+    def setUp(self):
+        self.slots = FakeSlots()
+        self.now = datetime.datetime(2013, 1, 1)
+
+    def acquire(self, holder, now=None):
+        return acquire_slot(self.slots, 'https://example.org', holder, 2, 60, now or self.now)
+
+    def test_backoff_grows_until_max_then_gives_up(self):
+        config = callback_config({'callback': {'backoff': 2, 'max_backoff': 10, 'max_retries': 4}})
+        self.assertEqual([retry_countdown(attempt, config) for attempt in range(5)], [2, 4, 8, 10, None])
+
+    def test_endpoint(self):
+        self.assertEqual(callback_endpoint('https://example.org:8443/hook?x=1'), 'https://example.org:8443')
+
+    def test_concurrency_limit(self):
+        self.assertEqual(self.acquire('a'), 0)
+        self.assertEqual(self.acquire('b'), 1)
+        self.assertEqual(self.acquire('c'), None)
+        release_slot(self.slots, 'https://example.org', 0, 'a')
+        self.assertEqual(self.acquire('c'), 0)
+
+    def test_release_by_another_holder_is_ignored(self):
+        self.acquire('a')
+        release_slot(self.slots, 'https://example.org', 0, 'b')
+        self.assertEqual(self.slots.slots[('https://example.org', 0)]['holder'], 'a')
+
+    def test_stale_slots_expire(self):
+        self.acquire('dead-1')
+        self.acquire('dead-2')
+        self.assertEqual(self.acquire('c', self.now + datetime.timedelta(seconds=30)), None)
+        self.assertEqual(self.acquire('c', self.now + datetime.timedelta(seconds=61)), 0)
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+
+from minion.backend.campaigns import new_campaign, release, scan_ended
+
+
+class FakeCampaigns:
+
+    """ Just enough of a collection for one campaign. """
+
+    def __init__(self, campaign):
+        self.campaign = campaign
+
+    def find_and_modify(self, spec, update, new=False):
+        c = self.campaign
+        if 'slots' in spec and not (c['state'] == 'RUNNING' and c['slots'] > 0 and c['waiting'] > 0):
+            return None
+        for field, value in update['$inc'].items():
+            if '.' in field:
+                parent, key = field.split('.')
+                c[parent][key] = c[parent].get(key, 0) + value
+            else:
+                c[field] += value
+        return c
+
+    def update(self, spec, update):
+        if '$set' in update:
+            self.campaign.update(update['$set'])
+        else:
+            self.find_and_modify(spec, update)
+
+
+class FakeScans:
+
+    """ Just enough of a collection for the scans of one campaign. """
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find_and_modify(self, spec, update, sort=None):
+        for doc in self.docs:
+            if 'meta.campaign_done' in spec:
+                if doc['id'] == spec['id'] and 'campaign_done' not in doc['meta']:
+                    doc['meta']['campaign_done'] = True
+                    return doc
+            elif doc['state'] == spec['state']:
+                for field, value in update['$set'].items():
+                    if field.startswith('meta.'):
+                        doc['meta'][field[5:]] = value
+                    else:
+                        doc[field] = value
+                return doc
+
+
+def scan(scan_id):
+    return {'id': scan_id, 'state': 'CREATED', 'queued': None, 'sessions': [],
+            'meta': {'campaign': 'campaign'}}
+
+
+class TestCampaigns(unittest.TestCase):
+
+    def setUp(self):
+        self.scans = FakeScans([scan('scan-%d' % i) for i in range(3)])
+        self.campaigns = FakeCampaigns(new_campaign('campaign', 'group', 'basic', 'bob@example.org',
+                                                    [s['id'] for s in self.scans.docs], 1))
+
+    def test_release_marks_scans_released(self):
+        self.assertEqual(release(self.campaigns, self.scans, 'campaign'), ['scan-0'])
+        self.assertTrue(self.scans.docs[0]['meta']['released'])
+        self.assertFalse('released' in self.scans.docs[1]['meta'])
+
+    def test_stopping_unreleased_scan_takes_no_slot(self):
+        release(self.campaigns, self.scans, 'campaign')
+        # STOP sets queued on a scan that was never released
+        unreleased = self.scans.docs[2]
+        unreleased['queued'] = datetime.datetime.utcnow()
+        unreleased['state'] = 'STOPPED'
+        self.assertEqual(scan_ended(self.campaigns, self.scans, unreleased, 'STOPPED'), [])
+        campaign = self.campaigns.campaign
+        self.assertEqual((campaign['slots'], campaign['waiting'], campaign['done']), (0, 1, 1))
+
+    def test_ended_released_scan_frees_its_slot(self):
+        release(self.campaigns, self.scans, 'campaign')
+        self.scans.docs[0]['state'] = 'FINISHED'
+        self.assertEqual(scan_ended(self.campaigns, self.scans, self.scans.docs[0], 'FINISHED'), ['scan-1'])
+        campaign = self.campaigns.campaign
+        self.assertEqual((campaign['slots'], campaign['waiting'], campaign['done']), (0, 1, 1))
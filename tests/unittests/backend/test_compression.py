@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import json
+import unittest
+import zlib
+from cStringIO import StringIO
+
+from flask import Flask, jsonify
+
+from minion.backend.compression import DEFAULT_COMPRESSION_CONFIG, init_compression
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        @app.route('/large')
+        def large():
+            return jsonify(success=True, text="Minion " * 1000)
+        @app.route('/small')
+        def small():
+            return jsonify(success=True)
+        @app.route('/vary')
+        def vary():
+            response = jsonify(success=True)
+            response.headers['Vary'] = 'Cookie, accept-encoding'
+            return response
+        @app.route('/cookie')
+        def cookie():
+            response = jsonify(success=True)
+            response.headers['Vary'] = 'Cookie'
+            return response
+        init_compression(app, {'api': {'compression': {'min_size': 512}}})
+        self.client = app.test_client()
+
+    def test_gzip(self):
+        r = self.client.get('/large', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(r.headers['Content-Length']), len(r.data))
+        data = gzip.GzipFile(fileobj=StringIO(r.data)).read()
+        self.assertEqual(json.loads(data)['text'], "Minion " * 1000)
+
+    def test_deflate(self):
+        r = self.client.get('/large', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(r.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(r.data))['success'], True)
+
+    def test_no_accept_encoding(self):
+        r = self.client.get('/large')
+        self.assertTrue('Content-Encoding' not in r.headers)
+        self.assertEqual(json.loads(r.data)['success'], True)
+
+    def test_small_response_is_not_compressed(self):
+        r = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue('Content-Encoding' not in r.headers)
+        self.assertEqual(r.headers['Vary'], 'Accept-Encoding')
+
+    def test_vary_is_merged(self):
+        r = self.client.get('/cookie')
+        self.assertEqual(r.headers.getlist('Vary'), ['Cookie, Accept-Encoding'])
+        r = self.client.get('/vary')
+        self.assertEqual(r.headers.getlist('Vary'), ['Cookie, accept-encoding'])
+
+    def test_defaults_are_not_modified(self):
+        self.assertEqual(DEFAULT_COMPRESSION_CONFIG['min_size'], 1024)
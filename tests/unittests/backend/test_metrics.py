@@ -0,0 +1,62 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from flask import Flask, jsonify
+from mock import MagicMock
+
+from minion.backend import metrics
+from minion.backend.metrics import Registry, init_metrics
+from minion.backend.mongo import InstrumentedCollection
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_counter(self):
+        registry = Registry()
+        registry.describe("requests_total", "counter", "Requests.")
+        registry.inc("requests_total", {'route': '/scans'})
+        registry.inc("requests_total", {'route': '/scans'}, 2)
+        text = registry.render()
+        self.assertTrue("# TYPE requests_total counter" in text)
+        self.assertTrue('requests_total{route="/scans"} 3.0' in text)
+
+    def test_histogram(self):
+        registry = Registry()
+        registry.observe("latency", 0.3, {'route': '/'}, buckets=(0.1, 0.5, 1.0))
+        registry.observe("latency", 0.7, {'route': '/'}, buckets=(0.1, 0.5, 1.0))
+        text = registry.render()
+        self.assertTrue('latency_bucket{route="/",le="0.1"} 0.0' in text)
+        self.assertTrue('latency_bucket{route="/",le="0.5"} 1.0' in text)
+        self.assertTrue('latency_bucket{route="/",le="1.0"} 2.0' in text)
+        self.assertTrue('latency_bucket{route="/",le="+Inf"} 2.0' in text)
+        self.assertTrue('latency_count{route="/"} 2.0' in text)
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        self.collection.name = 'scans'
+        self.collection.find.return_value = self.collection.cursor
+        self.collection.cursor.sort.return_value = self.collection.cursor
+        self.collection.cursor.next.side_effect = [{'id': 1}, {'id': 2}, StopIteration()]
+        scans = InstrumentedCollection(self.collection)
+
+        app = Flask(__name__)
+        @app.route('/scans/<scan_id>')
+        def get_scan(scan_id):
+            scans.find_one({'id': scan_id})
+            return jsonify(scans=list(scans.find({}).sort('created', -1)))
+        init_metrics(app)
+        self.client = app.test_client()
+
+    def test_request_is_recorded(self):
+        labels = {'route': '/scans/<scan_id>'}
+        queries = metrics.registry.counter("minion_http_mongo_queries_total", labels)
+        self.client.get('/scans/1234')
+        self.assertEqual(metrics.registry.counter("minion_http_mongo_queries_total", labels), queries + 2)
+        self.assertTrue(metrics.registry.counter("minion_http_requests_total",
+                                                 dict(labels, method='GET', status=200)) >= 1)
@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from mock import MagicMock, patch
+
+from minion.backend.mongo import InstrumentedCursor, SlowOperationLog, filter_shape, summarize_explain
+
+
+class TestSlowOperationLog(unittest.TestCase):
+
+    def test_filter_shape(self):
+        spec = {'configuration.target': {'$in': ['http://a', 'http://b']}, 'plan.name': 'basic'}
+        self.assertEqual(filter_shape(spec), {'configuration.target': {'$in': ['?']}, 'plan.name': '?'})
+
+    def test_summarize_legacy_explain(self):
+        self.assertEqual(summarize_explain({'cursor': 'BasicCursor', 'nscanned': 1000, 'nscannedObjects': 1000, 'n': 1}),
+                         {'plan': 'COLLSCAN', 'index': None, 'examined': 1000, 'returned': 1})
+        self.assertEqual(summarize_explain({'cursor': 'BtreeCursor id_1', 'nscanned': 1, 'nscannedObjects': 1, 'n': 1})['index'],
+                         'id_1')
+
+    def test_summarize_explain(self):
+        explain = {'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                                                    'inputStage': {'stage': 'IXSCAN', 'indexName': 'id_1'}}},
+                   'executionStats': {'totalDocsExamined': 1, 'nReturned': 1}}
+        self.assertEqual(summarize_explain(explain),
+                         {'plan': 'IXSCAN', 'index': 'id_1', 'examined': 1, 'returned': 1})
+
+    def test_slow_operations_are_explained_once(self):
+        collection = MagicMock()
+        collection.name = 'scans'
+        collection.find.return_value.explain.return_value = {'cursor': 'BasicCursor', 'n': 0}
+        log = SlowOperationLog(0.1, 300)
+        log.check(collection, 'find', {'id': 'a'}, 0.05)
+        self.assertFalse(collection.find.called)
+        log.check(collection, 'find', {'id': 'a'}, 0.5)
+        log.check(collection, 'find', {'id': 'b'}, 0.5)
+        log.wait()
+        self.assertEqual(collection.find.call_count, 1)
+
+    def test_slow_operations_are_logged_without_plan_when_explains_pile_up(self):
+        collection = MagicMock()
+        collection.name = 'scans'
+        log = SlowOperationLog(0.1, 0, max_pending=1)
+        with patch.object(log, '_start'), patch('minion.backend.mongo.logger') as logger:
+            log.check(collection, 'find', {'id': 'a'}, 0.5)
+            self.assertFalse(logger.warning.called)
+            log.check(collection, 'find', {'id': 'b'}, 0.5)
+        self.assertFalse(collection.find.called)
+        self.assertEqual(logger.warning.call_count, 1)
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = list(docs)
+        self.closed = False
+
+    def next(self):
+        if not self.docs:
+            raise StopIteration
+        return self.docs.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class TestInstrumentedCursor(unittest.TestCase):
+
+    def cursor(self):
+        collection = MagicMock()
+        collection.name = 'scans'
+        return InstrumentedCursor(FakeCursor([{'id': 'a'}, {'id': 'b'}]), collection, {'state': 'QUEUED'})
+
+    @patch('minion.backend.mongo.slow_operations')
+    def test_exhausted_cursor_is_checked_once(self, slow_operations):
+        cursor = self.cursor()
+        self.assertEqual(len(list(cursor)), 2)
+        cursor.close()
+        self.assertEqual(slow_operations.check.call_count, 1)
+
+    @patch('minion.backend.mongo.slow_operations')
+    def test_partly_read_cursor_is_checked_when_closed(self, slow_operations):
+        cursor = self.cursor()
+        cursor.next()
+        self.assertFalse(slow_operations.check.called)
+        cursor.close()
+        self.assertTrue(cursor._cursor.closed)
+        self.assertEqual(slow_operations.check.call_count, 1)
+
+    @patch('minion.backend.mongo.slow_operations')
+    def test_partly_read_cursor_is_checked_when_collected(self, slow_operations):
+        cursor = self.cursor()
+        cursor.next()
+        del cursor
+        self.assertEqual(slow_operations.check.call_count, 1)
+
+    @patch('minion.backend.mongo.slow_operations')
+    def test_unread_cursor_is_not_checked(self, slow_operations):
+        cursor = self.cursor()
+        del cursor
+        self.assertFalse(slow_operations.check.called)
@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from minion.backend.profiler import SamplingProfiler
+
+
+def busy_function(profiler):
+    profiler.sample()
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler(0.01, 60, self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_samples_are_written_per_label(self):
+        self.profiler.enter("GET /scans/<scan_id>")
+        busy_function(self.profiler)
+        busy_function(self.profiler)
+        self.profiler.leave()
+        self.profiler.flush()
+
+        path = os.path.join(self.directory, "GET__scans__scan_id.%d.folded" % os.getpid())
+        with open(path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertTrue(stack.startswith("GET /scans/<scan_id>;"))
+        self.assertTrue(stack.endswith("test_profiler:busy_function;minion.backend.profiler:sample"))
+        self.assertEqual(int(count), 2)
+
+    def test_threads_without_label_are_not_sampled(self):
+        busy_function(self.profiler)
+        self.profiler.flush()
+        self.assertEqual(os.listdir(self.directory), [])
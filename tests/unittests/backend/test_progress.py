@@ -0,0 +1,41 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend.progress import ProgressThrottle, progress_interval
+
+
+class TestProgressThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.throttle = ProgressThrottle(5, self.sent.append)
+
+    def test_first_update_is_sent(self):
+        self.throttle.update('1%', now=0)
+        self.assertEqual(self.sent, ['1%'])
+
+    def test_updates_within_interval_are_coalesced(self):
+        self.throttle.update('1%', now=0)
+        self.throttle.update('2%', now=1)
+        self.throttle.update('3%', now=2)
+        self.throttle.poll(now=4)
+        self.assertEqual(self.sent, ['1%'])
+        self.throttle.poll(now=5)
+        self.assertEqual(self.sent, ['1%', '3%'])
+        self.throttle.poll(now=20)
+        self.assertEqual(self.sent, ['1%', '3%'])
+
+    def test_flush_sends_final_state(self):
+        self.throttle.update('1%', now=0)
+        self.throttle.update('100%', now=1)
+        self.throttle.flush(now=1)
+        self.assertEqual(self.sent, ['1%', '100%'])
+        self.throttle.flush(now=2)
+        self.assertEqual(self.sent, ['1%', '100%'])
+
+    def test_progress_interval(self):
+        self.assertEqual(progress_interval({}), 5)
+        self.assertEqual(progress_interval({'plugin_worker': {'progress_interval': 1}}), 1)
@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import threading
+import unittest
+
+from minion.backend.reaper import LeaseKeeper, orphaned_sessions, requeue_scan
+
+
+class FakeScans:
+
+    """ Records updates and returns the scans it was given. """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.updates = []
+
+    def find(self, spec):
+        return [doc for doc in self.docs if doc['state'] == spec['state']]
+
+    def find_and_modify(self, spec, update):
+        self.updates.append((spec, update))
+        return self.docs[0]
+
+
+def session(session_id, state, expires=None):
+    s = {'id': session_id, 'state': state, 'issues': ['issue'], 'progress': 'half way',
+         'queued': None, 'started': None, 'finished': None}
+    if expires is not None:
+        s['lease'] = {'worker': 'worker:1', 'expires': expires}
+    return s
+
+
+class TestReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        self.expired = self.now - datetime.timedelta(seconds=1)
+        self.fresh = self.now + datetime.timedelta(seconds=60)
+
+    def test_orphaned_sessions_have_expired_leases(self):
+        scan = {'id': 'scan', 'state': 'STARTED',
+                'sessions': [session('finished', 'FINISHED', self.expired),
+                             session('lost', 'STARTED', self.expired),
+                             session('alive', 'STARTED', self.fresh),
+                             session('legacy', 'STARTED')]}
+        orphans = orphaned_sessions(FakeScans([scan]), self.now)
+        self.assertEqual([s['id'] for scan, s in orphans], ['lost'])
+
+    def test_requeue_resets_unfinished_sessions_only(self):
+        scan = {'id': 'scan', 'state': 'STARTED',
+                'meta': {'lease': {'worker': 'worker:1', 'expires': self.expired}},
+                'sessions': [session('finished', 'FINISHED'),
+                             session('running', 'STARTED', self.fresh),
+                             session('queued', 'QUEUED')]}
+        scans = FakeScans([scan])
+        self.assertTrue(requeue_scan(scans, scan))
+        spec, update = scans.updates[0]
+        self.assertEqual(spec['meta.lease.expires'], self.expired)
+        self.assertEqual(update['$set']['state'], 'QUEUED')
+        self.assertEqual(update['$set']['meta.dispatched'], None)
+        self.assertEqual(update['$inc'], {'meta.requeues': 1})
+        sessions = update['$set']['sessions']
+        self.assertEqual([s['state'] for s in sessions], ['FINISHED', 'CREATED', 'CREATED'])
+        self.assertEqual(sessions[0]['issues'], ['issue'])
+        self.assertEqual(sessions[1]['issues'], [])
+        self.assertFalse('lease' in sessions[1])
+
+    def test_lease_keeper_renews_until_stopped(self):
+        renewed = threading.Event()
+        expiries = []
+        def renew(expires):
+            expiries.append(expires)
+            renewed.set()
+        keeper = LeaseKeeper(30, renew)
+        keeper.start()
+        renewed.wait(5)
+        keeper.stop()
+        keeper._thread.join(5)
+        self.assertEqual(len(expiries), 1)
+        self.assertFalse(keeper._thread.is_alive())
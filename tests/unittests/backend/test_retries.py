@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend.retries import plugin_policy, rerun_scan, rerun_sessions, retry_config, retry_delay, should_retry
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = retry_config({'retry': {'plugins': {'minion.plugins.garmr.GarmrPlugin': {'max_attempts': 3}}}})
+
+    def test_default_policy_does_not_retry(self):
+        policy = plugin_policy(self.config, 'minion.plugins.basic.HSTSPlugin')
+        self.assertFalse(should_retry(policy, 1, 'FAILED'))
+
+    def test_plugin_policy_overrides_default(self):
+        policy = plugin_policy(self.config, 'minion.plugins.garmr.GarmrPlugin')
+        self.assertEqual(policy['max_attempts'], 3)
+        self.assertEqual(policy['backoff'], 30)
+        self.assertFalse('plugins' in policy)
+
+    def test_retry_on_states_and_failure_reasons(self):
+        policy = dict(plugin_policy(self.config, 'minion.plugins.garmr.GarmrPlugin'), retry_on=['TERMINATED', 'plugin-worker-lost'])
+        self.assertTrue(should_retry(policy, 1, 'TERMINATED'))
+        self.assertTrue(should_retry(policy, 2, 'FAILED', {'reason': 'plugin-worker-lost'}))
+        self.assertFalse(should_retry(policy, 1, 'FAILED', {'reason': 'backend-exception'}))
+        self.assertFalse(should_retry(policy, 3, 'TERMINATED'))
+
+    def test_stopped_sessions_are_never_retried(self):
+        policy = dict(plugin_policy(self.config, 'minion.plugins.garmr.GarmrPlugin'), retry_on=['STOPPED'])
+        self.assertFalse(should_retry(policy, 1, 'STOPPED'))
+
+    def test_backoff_doubles_up_to_max(self):
+        policy = plugin_policy(self.config, 'minion.plugins.garmr.GarmrPlugin')
+        self.assertEqual([retry_delay(policy, attempt) for attempt in range(1, 6)], [30, 60, 120, 240, 300])
+
+    def test_rerun_resets_sessions_that_did_not_finish(self):
+        def session(state):
+            return {'state': state, 'issues': [{}], 'queued': None, 'started': None, 'finished': None,
+                    'failure': {'reason': 'plugin-inactive'}}
+        sessions, count = rerun_sessions([session('FINISHED'), session('TERMINATED'), session('CREATED')])
+        self.assertEqual(count, 2)
+        self.assertEqual([s['state'] for s in sessions], ['FINISHED', 'CREATED', 'CREATED'])
+        self.assertEqual(sessions[0]['issues'], [{}])
+        self.assertEqual(sessions[1]['issues'], [])
+        self.assertEqual(sessions[1]['attempts'][0]['state'], 'TERMINATED')
+        self.assertEqual(sessions[1]['attempts'][0]['failure'], {'reason': 'plugin-inactive'})
+        self.assertFalse('failure' in sessions[1])
+
+    def test_rerun_scan_clears_the_previous_run(self):
+        class FakeScans:
+            def find_and_modify(self, spec, update):
+                self.spec, self.update = spec, update
+                return {}
+        scans = FakeScans()
+        scan = {'id': 'scan', 'state': 'FAILED', 'sessions': [],
+                'meta': {'lease': {'worker': 'worker:1'}, 'requeues': 1}}
+        self.assertTrue(rerun_scan(scans, scan, [], 'bob@example.org'))
+        self.assertEqual(scans.spec, {'id': 'scan', 'state': 'FAILED'})
+        self.assertEqual(scans.update['$set']['state'], 'QUEUED')
+        self.assertEqual(scans.update['$set']['meta.requeues'], 0)
+        self.assertEqual(scans.update['$set']['meta.dispatched'], None)
+        self.assertEqual(scans.update['$unset'], {'failure': 1, 'meta.lease': 1})
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+
+from minion.backend.scheduler import (DEFAULT_SCHEDULER_CONFIG, admit, dispatch, queue_for_priority,
+                                      scan_priority, share_usage)
+
+
+class FakeCursor(list):
+    def count(self):
+        return len(self)
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda doc: doc[key], reverse=direction < 0))
+
+
+class FakeScans:
+
+    """ Just enough of a collection for the scheduler. """
+
+    def __init__(self):
+        self.docs = []
+
+    def add(self, scan_id, tenant, state='QUEUED', dispatched=None, priority='interactive'):
+        queued = datetime.datetime(2013, 1, 1) + datetime.timedelta(seconds=len(self.docs))
+        self.docs.append({'id': scan_id, 'state': state, 'queued': queued,
+                          'meta': {'user': tenant, 'tenant': tenant, 'dispatched': dispatched,
+                                   'priority': priority}})
+
+    def find(self, spec, fields=None):
+        if 'meta.dispatched' in spec:
+            return FakeCursor(doc for doc in self.docs
+                              if doc['state'] == spec['state'] and doc['meta']['dispatched'] is None)
+        return FakeCursor(doc for doc in self.docs if doc['state'] in spec['state']['$in'])
+
+    def find_and_modify(self, spec, update):
+        for doc in self.docs:
+            if doc['id'] == spec['id'] and doc['state'] == 'QUEUED' and doc['meta']['dispatched'] is None:
+                doc['meta']['dispatched'] = update['$set']['meta.dispatched']
+                return doc
+
+
+def config(**kwargs):
+    c = dict(DEFAULT_SCHEDULER_CONFIG)
+    c.update(kwargs)
+    return c
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scans = FakeScans()
+        self.started = []
+
+    def dispatch(self, config):
+        return dispatch(self.scans, config, start=lambda scan_id, priority, config: self.started.append((scan_id, priority)))
+
+    def test_unlimited_dispatches_everything(self):
+        for i in range(3):
+            self.scans.add("cron-%d" % i, "cron")
+        self.assertEqual(self.dispatch(config()), ["cron-0", "cron-1", "cron-2"])
+
+    def test_tenants_take_turns(self):
+        for i in range(4):
+            self.scans.add("cron-%d" % i, "cron")
+        self.scans.add("alice-0", "alice")
+        self.scans.add("alice-1", "alice")
+        self.assertEqual(self.dispatch(config(max_running=4)), ["cron-0", "alice-0", "cron-1", "alice-1"])
+
+    def test_running_scans_count_against_the_tenant(self):
+        self.scans.add("cron-running", "cron", state='STARTED', dispatched=datetime.datetime.utcnow())
+        self.scans.add("cron-0", "cron")
+        self.scans.add("alice-0", "alice")
+        self.assertEqual(self.dispatch(config(max_running=2)), ["alice-0"])
+
+    def test_tenant_caps(self):
+        for i in range(3):
+            self.scans.add("cron-%d" % i, "cron")
+        self.scans.add("alice-0", "alice")
+        self.assertEqual(self.dispatch(config(tenant_cap=2, caps={'cron': 1})), ["cron-0", "alice-0"])
+        self.assertEqual(self.dispatch(config(tenant_cap=2, caps={'cron': 1})), [])
+
+    def test_weights(self):
+        for i in range(4):
+            self.scans.add("cron-%d" % i, "cron")
+            self.scans.add("alice-%d" % i, "alice")
+        dispatched = self.dispatch(config(max_running=6, weights={'alice': 2}))
+        self.assertEqual(len([s for s in dispatched if s.startswith("alice")]), 4)
+
+    def test_interactive_scans_go_first(self):
+        for i in range(4):
+            self.scans.add("cron-%d" % i, "cron", priority='batch')
+        self.scans.add("alice-0", "alice")
+        self.scans.add("bob-0", "bob")
+        dispatched = self.dispatch(config(max_running=4, batch_min_share=0))
+        self.assertEqual(dispatched, ["alice-0", "bob-0", "cron-0", "cron-1"])
+        self.assertEqual(self.started[0], ("alice-0", "interactive"))
+        self.assertEqual(self.started[2], ("cron-0", "batch"))
+
+    def test_batch_scans_get_their_minimum_share(self):
+        for i in range(4):
+            self.scans.add("cron-%d" % i, "cron", priority='batch')
+            self.scans.add("alice-%d" % i, "alice")
+        dispatched = self.dispatch(config(max_running=4, batch_min_share=0.5))
+        self.assertEqual(dispatched, ["cron-0", "cron-1", "alice-0", "alice-1"])
+
+    def test_queue_for_priority(self):
+        self.assertEqual(queue_for_priority('plugin', 'batch', config()), 'plugin')
+        self.assertEqual(queue_for_priority('plugin', 'batch', config(batch_queues=True)), 'plugin-batch')
+        self.assertEqual(queue_for_priority('scan', 'interactive', config(batch_queues=True)), 'scan')
+
+    def test_scan_priority(self):
+        self.assertEqual(scan_priority('cron', None, config()), 'batch')
+        self.assertEqual(scan_priority('alice', None, config()), 'interactive')
+        self.assertEqual(scan_priority('cron', 'interactive', config()), 'interactive')
+
+    def test_scans_without_the_lease_wait(self):
+        self.scans.add("cron-0", "cron")
+        self.scans.add("cron-1", "cron")
+        self.scans.add("alice-0", "alice")
+        holders = {"cron-1": "cron-0"}
+        dispatched = dispatch(self.scans, config(), start=lambda *args: None,
+                              acquire=lambda scan: holders.get(scan['id'], scan['id']))
+        self.assertEqual(dispatched, ["cron-0", "alice-0"])
+        self.assertEqual(share_usage(self.scans, config())[1]['pending'], 1)
+
+    def test_admission(self):
+        self.scans.add("cron-running", "cron", state='STARTED', dispatched=datetime.datetime.utcnow())
+        self.scans.add("cron-0", "cron")
+        self.assertTrue(admit(self.scans, config()))
+        self.assertTrue(admit(self.scans, config(max_pending=2)))
+        self.scans.add("cron-1", "cron")
+        self.assertFalse(admit(self.scans, config(max_pending=2)))
+
+    def test_share_usage(self):
+        self.scans.add("cron-running", "cron", state='STARTED', dispatched=datetime.datetime.utcnow())
+        self.scans.add("cron-0", "cron")
+        self.scans.add("alice-running", "alice", state='STARTED', dispatched=datetime.datetime.utcnow())
+        usage = share_usage(self.scans, config(tenant_cap=5))
+        self.assertEqual(usage, [{'tenant': 'alice', 'running': 1, 'pending': 0, 'cap': 5, 'weight': 1.0, 'share': 0.5},
+                                 {'tenant': 'cron', 'running': 1, 'pending': 1, 'cap': 5, 'weight': 1.0, 'share': 0.5}])
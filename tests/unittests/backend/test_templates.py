@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend import templates
+
+
+PLUGINS = { 'minion.plugins.basic.AlivePlugin': {'descriptor': {'class': 'minion.plugins.basic.AlivePlugin'}} }
+
+def plan(revision=1, _id='plan-1'):
+    return { '_id': _id,
+             'name': 'basic',
+             'revision': revision,
+             'budget': 3600,
+             'workflow': [ { 'plugin_name': 'minion.plugins.basic.AlivePlugin',
+                             'description': 'Alive',
+                             'budget': 60,
+                             'configuration': { 'foo': 'bar' } } ] }
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        templates.invalidate('basic')
+
+    def test_template_is_cached_per_revision(self):
+        template = templates.template_for(plan(), PLUGINS)
+        self.assertTrue(templates.template_for(plan(), PLUGINS) is template)
+        self.assertFalse(templates.template_for(plan(revision=2), PLUGINS) is template)
+        self.assertFalse(templates.template_for(plan(revision=2, _id='plan-2'), PLUGINS) is template)
+
+    def test_invalidate(self):
+        template = templates.template_for(plan(), PLUGINS)
+        templates.invalidate('basic')
+        self.assertFalse(templates.template_for(plan(), PLUGINS) is template)
+
+    def test_new_scan(self):
+        p = plan(revision=3)
+        template = templates.template_for(p, PLUGINS)
+        scan1 = template.new_scan({'target': 'http://a'}, 'bob@example.org', 'interactive')
+        scan2 = template.new_scan({'target': 'http://b'}, 'bob@example.org', 'interactive', budget=600)
+        self.assertEqual(scan1['plan'], {'name': 'basic', 'revision': 3})
+        self.assertNotEqual(scan1['id'], scan2['id'])
+        self.assertNotEqual(scan1['sessions'][0]['id'], scan2['sessions'][0]['id'])
+        self.assertEqual(scan1['sessions'][0]['configuration'], {'foo': 'bar', 'target': 'http://a'})
+        self.assertEqual(scan2['sessions'][0]['configuration'], {'foo': 'bar', 'target': 'http://b'})
+        self.assertEqual(p['workflow'][0]['configuration'], {'foo': 'bar'})
+        self.assertEqual(scan1['meta']['budget'], {'scan': 3600, 'sessions': {scan1['sessions'][0]['id']: 60}})
+        self.assertEqual(scan2['meta']['budget']['scan'], 600)
@@ -0,0 +1,39 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend.tracing import Tracer
+
+
+class ListCollector:
+    def __init__(self):
+        self.spans = []
+    def collect(self, span):
+        self.spans.append(span)
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = ListCollector()
+        self.tracer = Tracer({'enabled': True}, self.collector)
+
+    def test_spans_are_linked(self):
+        trace = self.tracer.start_trace()
+        self.tracer.record_queue_wait(trace, "scan.queue_wait")
+        with self.tracer.span(trace, "scan", scan_id="1234") as child:
+            self.tracer.record_queue_wait(self.tracer.child(child), "plugin.queue_wait")
+        queue_wait, plugin_queue_wait, scan = self.collector.spans
+        self.assertEqual(set(s['trace_id'] for s in self.collector.spans), set([trace['trace_id']]))
+        self.assertEqual(queue_wait['parent_id'], None)
+        self.assertEqual(scan['attributes'], {'scan_id': '1234'})
+        self.assertEqual(plugin_queue_wait['parent_id'], scan['span_id'])
+
+    def test_disabled_or_untraced(self):
+        with self.tracer.span(None, "scan") as child:
+            self.assertEqual(child, None)
+        tracer = Tracer({'enabled': False}, self.collector)
+        tracer.record(tracer.start_trace(), "scan", 0, 1)
+        self.assertEqual(self.collector.spans, [])
@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import signal
+import unittest
+
+from minion.backend.watchdog import Watchdog, watchdog_config, watchdog_failure
+
+
+class TestWatchdog(unittest.TestCase):
+
+    def test_inactive_plugin_is_escalated(self):
+        watchdog = Watchdog(60, None, 10, now=0)
+        self.assertEqual(watchdog.check(now=59), None)
+        self.assertFalse(watchdog.triggered)
+        self.assertEqual(watchdog.check(now=60), signal.SIGUSR1)
+        self.assertTrue(watchdog.triggered)
+        self.assertEqual(watchdog.reason, 'plugin-inactive')
+        self.assertEqual(watchdog.check(now=69), None)
+        self.assertEqual(watchdog.check(now=70), signal.SIGTERM)
+        self.assertEqual(watchdog.check(now=79), None)
+        self.assertEqual(watchdog.check(now=80), signal.SIGKILL)
+        self.assertEqual(watchdog.check(now=1000), None)
+
+    def test_activity_resets_inactivity(self):
+        watchdog = Watchdog(60, None, 10, now=0)
+        watchdog.activity(now=50)
+        self.assertEqual(watchdog.check(now=100), None)
+        self.assertEqual(watchdog.check(now=110), signal.SIGUSR1)
+
+    def test_max_runtime_ignores_activity(self):
+        watchdog = Watchdog(60, 100, 10, now=0)
+        for t in range(0, 100, 30):
+            watchdog.activity(now=t)
+            self.assertEqual(watchdog.check(now=t), None)
+        self.assertEqual(watchdog.check(now=100), signal.SIGUSR1)
+        self.assertEqual(watchdog.reason, 'plugin-max-runtime-exceeded')
+
+    def test_unset_limits_never_trigger(self):
+        watchdog = Watchdog(*watchdog_config({}), now=0)
+        self.assertEqual(watchdog.check(now=10 ** 9), None)
+        self.assertFalse(watchdog.triggered)
+        self.assertEqual(watchdog_failure(watchdog, False), None)
+
+    def test_triggered_session_is_terminated(self):
+        watchdog = Watchdog(*watchdog_config({'plugin_worker': {'inactivity_timeout': 60}}), now=0)
+        watchdog.check(now=60)
+        failure = watchdog_failure(watchdog, False)
+        self.assertEqual(failure['reason'], 'plugin-inactive')
+        self.assertEqual(watchdog_failure(watchdog, True), None)
+
+    def test_untriggered_session_is_not_terminated(self):
+        watchdog = Watchdog(60, 100, 10, now=0)
+        self.assertEqual(watchdog.check(now=30), None)
+        self.assertEqual(watchdog_failure(watchdog, False), None)
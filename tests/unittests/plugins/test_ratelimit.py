@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from minion.ratelimit import MemoryStore, MongoStore, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeBuckets:
+    """ A bucket collection whose inserts fail with the given error. """
+    def __init__(self, error):
+        self.error = error
+    def ensure_index(self, *args, **kwargs):
+        pass
+    def insert(self, doc):
+        raise self.error
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(MemoryStore(), rate=2, burst=3,
+                                   clock=self.clock.time, sleep=self.clock.sleep)
+
+    def test_burst_is_allowed(self):
+        for i in range(3):
+            self.assertEqual(0, self.limiter.try_acquire("example.com"))
+        self.assertAlmostEqual(0.5, self.limiter.try_acquire("example.com"))
+
+    def test_tokens_refill(self):
+        for i in range(3):
+            self.limiter.try_acquire("example.com")
+        self.clock.now += 0.5
+        self.assertEqual(0, self.limiter.try_acquire("example.com"))
+        self.assertAlmostEqual(0.5, self.limiter.try_acquire("example.com"))
+
+    def test_hosts_are_limited_separately(self):
+        for i in range(3):
+            self.limiter.try_acquire("example.com")
+        self.assertEqual(0, self.limiter.try_acquire("example.org"))
+
+    def test_acquire_waits_for_rate(self):
+        start = self.clock.now
+        for i in range(7):
+            self.limiter.acquire("example.com")
+        # Three requests in the burst, then one every half second
+        self.assertAlmostEqual(2.0, self.clock.now - start)
+
+    def test_lost_race_is_retried(self):
+        store = MemoryStore()
+        limiter = RateLimiter(store, rate=2, burst=3, clock=self.clock.time, sleep=self.clock.sleep)
+        store.compare_and_set("example.com", None, self.clock.now)
+        original_get = store.get
+        store.get = lambda key: None
+        self.assertNotEqual(0, limiter.try_acquire("example.com"))
+        store.get = original_get
+        self.assertEqual(0, limiter.try_acquire("example.com"))
+
+
+class TestMongoStore(unittest.TestCase):
+
+    def test_duplicate_bucket_is_a_lost_race(self):
+        store = MongoStore(FakeBuckets(DuplicateKeyError("duplicate key")))
+        self.assertFalse(store.compare_and_set("example.com", None, 1000.0))
+
+    def test_other_errors_are_raised(self):
+        store = MongoStore(FakeBuckets(OperationFailure("not master")))
+        self.assertRaises(OperationFailure, store.compare_and_set, "example.com", None, 1000.0)